@@ -1,24 +1,90 @@
 # Final corrected __init__.py (with detailed logging and findNotes added)
 
 import json
+import logging
+import mmap
+import os
+import queue
+import tempfile
 import threading
 import base64
+import bisect
 import hashlib
-import traceback
 import re
+import selectors
+import socket
+import sys
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse, parse_qs
 from threading import Event
+from concurrent.futures import ThreadPoolExecutor
 
-from aqt import mw
+try:
+    import orjson # Bundled with recent Anki; plain json is used when it is missing
+except ImportError:
+    orjson = None
+
+from aqt import mw, gui_hooks
 from aqt.utils import tooltip
 from anki.notes import Note
-from anki.hooks import addHook
+from anki.utils import ids2str
+try:
+    from anki.utils import field_checksum, strip_html_media
+except ImportError: # Anki 2.1.49 only has the camelCase names
+    from anki.utils import fieldChecksum as field_checksum, stripHTMLMedia as strip_html_media
+from anki.hooks import addHook, notes_will_be_deleted
 from aqt.qt import QAction, QMessageBox, Qt
 
 LOG_PREFIX = "Apro-Bridge-Log:" # Added for easy log filtering
 HOST = 'localhost'
 PORT = 8767
+MAX_WORKERS = 16 # Requests served in parallel by the worker pool
+MAX_IN_FLIGHT = 64 # Requests accepted (running + queued) before answering 503
+KEEP_ALIVE_TIMEOUT = 15 # Seconds an idle persistent connection is kept open
+MAX_IDLE_CONNECTIONS = 256 # Idle persistent connections kept; beyond this the longest idle one is closed
+MAX_REQUESTS_PER_CONNECTION = 1000 # Requests served before a connection is closed
+CORS_MAX_AGE = 86400 # Seconds browsers may cache a preflight response
+MEDIA_CHUNK_SIZE = 1024 * 1024 # Bytes read per chunk for binary media uploads
+MEDIA_EXTENSION_RE = re.compile(r"[A-Za-z0-9]{1,16}")
+MEDIA_FILENAME_RE = re.compile(r"apro-bridge-([0-9a-f]{40})\.(.+)")
+MEDIA_INGEST_WORKERS = min(8, os.cpu_count() or 2) # Threads decoding, hashing and writing bulk media uploads
+MEDIA_BUFFER_LIMIT = 16 * 1024 * 1024 # Archive members up to this size are hashed in memory before writing
+MULTIPART_FILENAME_RE = re.compile(r'filename="([^"]*)"')
+MULTIPART_NAME_RE = re.compile(r'\bname="([^"]*)"')
+SHA1_RE = re.compile(r"[0-9a-fA-F]{40}")
+CLOZE_FIELD_RE = re.compile(r"\{\{cloze:(.*?)\}\}")
+MAIN_THREAD_SLICE_SIZE = 500 # Notes handled per main-thread slice before yielding to the UI
+JOB_HISTORY_SIZE = 50 # Recent main-thread jobs kept for /metrics
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Histogram bounds in seconds
+REQUEST_STAGES = ("read", "parse", "queue_wait", "main_thread", "serialize", "compress", "write", "total")
+LOG_LEVEL = logging.INFO # Level written to user_files/apro-bridge.log
+CONSOLE_LOG_LEVEL = logging.WARNING # Level echoed to stdout with LOG_PREFIX
+LOG_FILE_MAX_BYTES = 1024 * 1024 # Log file size before it is rotated
+LOG_FILE_BACKUPS = 3 # Rotated log files kept
+ERROR_TOOLTIP_INTERVAL = 5 # Minimum seconds between two error tooltips
+ERROR_TOOLTIP_DEDUP_WINDOW = 60 # Seconds during which an identical error is not shown again
+SEARCH_CURSOR_TTL = 120 # Seconds a search result is kept for follow-up pages
+SEARCH_CURSOR_CACHE_SIZE = 16 # Searches kept for cursor pagination
+STREAM_ID_CHUNK = 10000 # Note IDs written per chunk when streaming findNotes
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+WRITE_COALESCE_WINDOW = 0.01 # Seconds single-note writes wait to be merged with writes to the same note
+IDEMPOTENCY_TTL = 600 # Seconds the response to an Idempotency-Key is replayed
+IDEMPOTENCY_CACHE_SIZE = 1000 # Idempotency-Key responses kept
+IDEMPOTENCY_WAIT_TIMEOUT = 60 # Seconds a retry waits for the original request to finish
+CHANGES_PAGE_SIZE = 500 # Notes returned per changesSince page by default
+CHANGES_MAX_WAIT = 30 # Longest changesSince long-poll in seconds
+CHANGES_DELETED_LOG_SIZE = 10000 # Deleted note IDs remembered for changesSince
+COMPRESSION_MIN_SIZE = 1024 # Response bodies smaller than this are sent uncompressed
+COMPRESSION_LEVEL = 6 # zlib level for gzip/deflate responses
+
+logger = logging.getLogger("apro_bridge")
+logger.propagate = False
+logger.addHandler(logging.NullHandler())
 
 def show_about_window():
     about_text = """
@@ -37,64 +103,1290 @@ def show_about_window():
     msg_box.setText(about_text)
     msg_box.exec()
 
+class StructuredFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, merging any extra={'fields': {...}}."""
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class _OneLineFormatter(logging.Formatter):
+    # Tracebacks go to the log file only; the console gets the summary line.
+    def format(self, record):
+        return f"{LOG_PREFIX} {record.levelname} {record.getMessage()}"
+
+class _BackgroundQueueHandler(QueueHandler):
+    # Records only cross threads, so keep exc_info and let the listener
+    # thread pay for formatting the traceback.
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+_log_listener = None
+
+def start_logging():
+    """Route the bridge logger through a queue to a rotating file and the console."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_files")
+    os.makedirs(log_dir, exist_ok=True)
+
+    file_handler = RotatingFileHandler(os.path.join(log_dir, "apro-bridge.log"), maxBytes=LOG_FILE_MAX_BYTES,
+                                       backupCount=LOG_FILE_BACKUPS, encoding='utf-8')
+    file_handler.setLevel(LOG_LEVEL)
+    file_handler.setFormatter(StructuredFormatter())
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(CONSOLE_LOG_LEVEL)
+    console_handler.setFormatter(_OneLineFormatter())
+
+    log_queue = queue.SimpleQueue()
+    _log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _log_listener.start()
+    logger.handlers = [_BackgroundQueueHandler(log_queue)]
+    logger.setLevel(min(LOG_LEVEL, CONSOLE_LOG_LEVEL))
+
+def stop_logging():
+    global _log_listener
+    if _log_listener is None:
+        return
+    logger.handlers = [logging.NullHandler()]
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_listener = None
+
+class ErrorNotifier:
+    """Shows request errors as tooltips without letting error storms flood the UI.
+
+    An identical error is shown at most once per ERROR_TOOLTIP_DEDUP_WINDOW and
+    no two tooltips are closer than ERROR_TOOLTIP_INTERVAL; skipped errors are
+    counted and mentioned in the next tooltip. Full details go to the log.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_shown = {}
+        self._last_any = None
+        self._suppressed = 0
+
+    def notify(self, method, error):
+        key = (method, type(error).__name__, str(error))
+        now = time.monotonic()
+        with self._lock:
+            last_same = self._last_shown.get(key)
+            if (last_same is not None and now - last_same < ERROR_TOOLTIP_DEDUP_WINDOW) or \
+                    (self._last_any is not None and now - self._last_any < ERROR_TOOLTIP_INTERVAL):
+                self._suppressed += 1
+                return
+            if len(self._last_shown) > 256:
+                self._last_shown = {k: t for k, t in self._last_shown.items() if now - t < ERROR_TOOLTIP_DEDUP_WINDOW}
+            self._last_shown[key] = now
+            self._last_any = now
+            suppressed, self._suppressed = self._suppressed, 0
+
+        message = f"Apro - Bridge Connector Error ({method}):\n{error}"
+        if suppressed:
+            message += f"\n({suppressed} more error(s) not shown; see user_files/apro-bridge.log)"
+        mw.taskman.run_on_main(lambda: tooltip(message, period=10000))
+
+error_notifier = ErrorNotifier()
+
+class MediaIndex:
+    """In-memory map of SHA-1 -> apro-bridge-* filenames in the media folder.
+
+    Built lazily by scanning the media folder the first time it is queried and
+    kept current by the upload paths. Hits are re-checked on disk so files
+    removed by Check Media are dropped instead of reported.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._media_dir = None
+        self._files = {}
+
+    def _ensure_loaded(self, media_dir):
+        if self._media_dir == media_dir:
+            return
+        files = {}
+        with os.scandir(media_dir) as entries:
+            for entry in entries:
+                match = MEDIA_FILENAME_RE.fullmatch(entry.name)
+                if match:
+                    files.setdefault(match.group(1), []).append(entry.name)
+        self._files = files
+        self._media_dir = media_dir
+
+    def lookup(self, hashes, extension=None):
+        """Return {hash: filename or None}, preferring files with the given extension."""
+        media_dir = mw.col.media.dir()
+        with self._lock:
+            self._ensure_loaded(media_dir)
+            candidates = {h: list(self._files.get(h.lower(), ())) for h in hashes}
+
+        results = {}
+        for sha1, filenames in candidates.items():
+            if extension:
+                filenames = [f for f in filenames if f.endswith(f".{extension}")]
+            found = None
+            for filename in filenames:
+                if os.path.exists(os.path.join(media_dir, filename)):
+                    found = filename
+                    break
+                self.discard(filename)
+            results[sha1] = found
+        return results
+
+    def add(self, filename):
+        match = MEDIA_FILENAME_RE.fullmatch(filename)
+        if not match:
+            return
+        with self._lock:
+            if self._media_dir is None:
+                return # Not built yet; the first lookup will scan the folder.
+            names = self._files.setdefault(match.group(1), [])
+            if filename not in names:
+                names.append(filename)
+
+    def discard(self, filename):
+        match = MEDIA_FILENAME_RE.fullmatch(filename)
+        if not match:
+            return
+        with self._lock:
+            names = self._files.get(match.group(1))
+            if names and filename in names:
+                names.remove(filename)
+                if not names:
+                    del self._files[match.group(1)]
+
+    def reset(self):
+        with self._lock:
+            self._media_dir = None
+            self._files = {}
+
+media_index = MediaIndex()
+
+def write_media_stream(chunks, extension):
+    """Spool byte chunks into the media folder as apro-bridge-<sha1>.<extension>.
+
+    The data is hashed while it is written to a hidden temporary file next to
+    the media files, then renamed into place, so memory use does not depend
+    on the file size. Returns (filename, written); written is False when the
+    file was already there.
+    """
+    if not MEDIA_EXTENSION_RE.fullmatch(extension):
+        raise ValueError(f"Invalid media extension '{extension}'.")
+
+    media_dir = mw.col.media.dir()
+    hasher = hashlib.sha1()
+    fd, temp_path = tempfile.mkstemp(prefix=".apro-bridge-", suffix=".part", dir=media_dir)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk in chunks:
+                hasher.update(chunk)
+                temp_file.write(chunk)
+
+        filename = f"apro-bridge-{hasher.hexdigest()}.{extension}"
+        final_path = os.path.join(media_dir, filename)
+        # Names are content hashes, so an existing file already holds these bytes.
+        written = not os.path.exists(final_path)
+        if written:
+            os.replace(temp_path, final_path)
+        media_index.add(filename)
+        return filename, written
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def write_media_data(data, extension):
+    """Store an in-memory buffer as apro-bridge-<sha1>.<extension>.
+
+    The buffer is hashed first and not written at all if the media index
+    already has the file. Returns (filename, written).
+    """
+    if not MEDIA_EXTENSION_RE.fullmatch(extension):
+        raise ValueError(f"Invalid media extension '{extension}'.")
+
+    sha1 = hashlib.sha1(data).hexdigest()
+    filename = f"apro-bridge-{sha1}.{extension}"
+    if media_index.lookup([sha1], extension)[sha1] == filename:
+        return filename, False
+
+    media_dir = mw.col.media.dir()
+    fd, temp_path = tempfile.mkstemp(prefix=".apro-bridge-", suffix=".part", dir=media_dir)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, os.path.join(media_dir, filename))
+        media_index.add(filename)
+        return filename, True
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def media_extension(name, default='unknown'):
+    extension = os.path.splitext(name or '')[1][1:]
+    return extension or default
+
+def iter_multipart_parts(buffer, boundary):
+    """Yield (headers, body_start, body_end) for each part of a multipart body.
+
+    buffer is typically an mmap of the spooled request, so only the part
+    headers are copied out of it. Header names are lower-cased.
+    """
+    delimiter = b"--" + boundary
+    position = buffer.find(delimiter)
+    if position < 0:
+        raise ValueError("Multipart body does not contain its boundary.")
+    while True:
+        position += len(delimiter)
+        if buffer[position:position + 2] == b"--":
+            return
+        header_end = buffer.find(b"\r\n\r\n", position)
+        if header_end < 0:
+            raise ValueError("Malformed multipart part headers.")
+        headers = {}
+        for line in buffer[position:header_end].decode('utf-8', 'replace').split("\r\n"):
+            name, separator, value = line.partition(":")
+            if separator:
+                headers[name.strip().lower()] = value.strip()
+        body_start = header_end + 4
+        body_end = buffer.find(b"\r\n" + delimiter, body_start)
+        if body_end < 0:
+            raise ValueError("Multipart body ended before its closing boundary.")
+        yield headers, body_start, body_end
+        position = body_end + 2
+
+def dump_json(data):
+    """Serialize data to compact UTF-8 JSON bytes, with orjson when it is available."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def negotiate_encoding(accept_encoding):
+    """Pick 'gzip' or 'deflate' from an Accept-Encoding header value, or None."""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().lower().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip()] = quality
+    for coding in ('gzip', 'deflate'):
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+def make_compressor(encoding):
+    # wbits 31 writes a gzip container, 15 the zlib container HTTP calls "deflate".
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+_request_timing = threading.local()
+
+def record_stage(stage, seconds):
+    """Add seconds to a stage of the request being served on this thread."""
+    stages = getattr(_request_timing, 'stages', None)
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+class RequestMetrics:
+    """Per-action latency histograms for each request stage, exported by /metrics."""
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, action, stages):
+        with self._lock:
+            for stage, seconds in stages.items():
+                histogram = self._histograms.get((action, stage))
+                if histogram is None:
+                    histogram = self._histograms[(action, stage)] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+                index = len(self.buckets)
+                for i, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        index = i
+                        break
+                histogram["counts"][index] += 1
+                histogram["sum"] += seconds
+                histogram["count"] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((key, dict(h, counts=list(h["counts"]))) for key, h in self._histograms.items())
+
+    def _quantile(self, histogram, q):
+        # Upper bound of the bucket holding the q-th observation (None past the last bound).
+        target = q * histogram["count"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, histogram["counts"]):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return None
+
+    def to_json(self):
+        actions = {}
+        for (action, stage), histogram in self._snapshot():
+            actions.setdefault(action, {})[stage] = {
+                "count": histogram["count"],
+                "sumSeconds": histogram["sum"],
+                "meanSeconds": histogram["sum"] / histogram["count"],
+                "p50Seconds": self._quantile(histogram, 0.5),
+                "p90Seconds": self._quantile(histogram, 0.9),
+                "p99Seconds": self._quantile(histogram, 0.99),
+            }
+        return actions
+
+    def to_prometheus(self, server_stats):
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = [
+            "# HELP apro_bridge_request_stage_seconds Time spent in each stage of a bridge request.",
+            "# TYPE apro_bridge_request_stage_seconds histogram",
+        ]
+        for (action, stage), histogram in self._snapshot():
+            labels = f'action="{label(action)}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram["counts"]):
+                cumulative += count
+                lines.append(f'apro_bridge_request_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'apro_bridge_request_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+            lines.append(f'apro_bridge_request_stage_seconds_sum{{{labels}}} {histogram["sum"]}')
+            lines.append(f'apro_bridge_request_stage_seconds_count{{{labels}}} {histogram["count"]}')
+
+        for name, key, kind, help_text in (
+            ("apro_bridge_requests_in_flight", "inFlight", "gauge", "Requests accepted and not yet finished."),
+            ("apro_bridge_requests_active", "active", "gauge", "Requests currently running on a worker."),
+            ("apro_bridge_request_queue_depth", "queueDepth", "gauge", "Requests waiting for a free worker."),
+            ("apro_bridge_idle_connections", "idleConnections", "gauge", "Keep-alive connections waiting for their next request."),
+            ("apro_bridge_requests_waiting", "waiting", "gauge", "Long-poll requests waiting for a change, off the worker pool."),
+            ("apro_bridge_requests_served_total", "served", "counter", "Requests served."),
+            ("apro_bridge_requests_rejected_total", "rejected", "counter", "Requests rejected with 503."),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {server_stats[key]}")
+        return "\n".join(lines) + "\n"
+
+request_metrics = RequestMetrics()
+
+class MainThreadScheduler:
+    """Runs collection work on the main thread via run_on_main and an Event.
+
+    Large jobs are split into slices of at most slice_size items. The calling
+    (HTTP) thread posts one slice at a time and waits for it, so the Qt event
+    loop gets to process input and repaints between slices instead of being
+    blocked for the whole job. Timings of recent jobs are kept for /metrics.
+    """
+    def __init__(self, slice_size=MAIN_THREAD_SLICE_SIZE):
+        self.slice_size = slice_size
+        self._lock = threading.Lock()
+        self.recent_jobs = deque(maxlen=JOB_HISTORY_SIZE)
+        self._batch = threading.local()
+        self._undo_scopes = [] # Undo scopes of the jobs running on the main thread, outermost first
+
+    def _run_slice(self, func):
+        if getattr(self._batch, 'active', False):
+            # Already inside a batch task on the main thread: run in place.
+            started_at = time.perf_counter()
+            return func(), 0.0, time.perf_counter() - started_at
+
+        result_container = [None]
+        error_container = [None]
+        timing = [0.0, 0.0]
+        task_done = Event()
+        posted_at = time.perf_counter()
+
+        def slice_sync():
+            started_at = time.perf_counter()
+            timing[0] = started_at - posted_at
+            try:
+                result_container[0] = func()
+            except Exception as e:
+                error_container[0] = e
+            finally:
+                timing[1] = time.perf_counter() - started_at
+                task_done.set()
+
+        mw.taskman.run_on_main(slice_sync)
+        task_done.wait()
+        record_stage("queue_wait", timing[0])
+        record_stage("main_thread", timing[1])
+
+        if error_container[0]:
+            raise error_container[0]
+        return result_container[0], timing[0], timing[1]
+
+    def run(self, job_name, func, undo_name=None, single_write=False):
+        """Run func() on the main thread in one go and return its result."""
+        return self.run_sliced(job_name, [None], lambda _: func(), slice_size=1, undo_name=undo_name, single_write=single_write)[0]
+
+    def run_batch(self, job_name, func):
+        """Run func() as one main-thread task in which nested jobs run inline, without slicing."""
+        def batch_sync():
+            self._batch.active = True
+            try:
+                return func()
+            finally:
+                self._batch.active = False
+        return self.run(job_name, batch_sync)
+
+    def run_sliced(self, job_name, items, process_slice, slice_size=None, undo_name=None, single_write=False):
+        """Run process_slice(chunk) over consecutive slices of items; return the per-slice results."""
+        return list(self.iter_slices(job_name, items, process_slice, slice_size, undo_name, single_write))
+
+    def iter_slices(self, job_name, items, process_slice, slice_size=None, undo_name=None, single_write=False):
+        """Yield process_slice(chunk) for each slice as soon as it has run on the main thread.
+
+        With undo_name, every collection change made by the slices is merged
+        into one custom undo entry, so the whole job undoes as a single step.
+        The entry is opened by begin_undo() right before the first write, so
+        a job that changes nothing leaves the undo history alone. If the user
+        changes or undoes something between two slices, the remaining slices
+        go into a new entry instead, so the user's step is never folded into
+        (or undone with) the bridge's. single_write says each slice makes at
+        most one undoable call; a one-slice job then needs no entry of its own.
+        """
+        slice_size = max(1, slice_size or self.slice_size)
+        job = {"job": job_name, "items": len(items), "slices": 0, "queueWaitSeconds": 0.0,
+               "mainThreadSeconds": 0.0, "maxSliceSeconds": 0.0, "wallSeconds": 0.0, "error": None}
+        undo_scope = None
+        if undo_name and not (single_write and len(items) <= slice_size):
+            undo_scope = self.new_undo_scope(undo_name)
+
+        def run_chunk(chunk):
+            if undo_scope is None:
+                return process_slice(chunk)
+            self.enter_undo_scope(undo_scope)
+            try:
+                return process_slice(chunk)
+            finally:
+                self.exit_undo_scope(undo_scope)
+
+        started_at = time.perf_counter()
+        try:
+            for start in range(0, len(items), slice_size):
+                chunk = items[start:start + slice_size]
+                result, queue_wait, run_time = self._run_slice(lambda: run_chunk(chunk))
+                job["slices"] += 1
+                job["queueWaitSeconds"] += queue_wait
+                job["mainThreadSeconds"] += run_time
+                job["maxSliceSeconds"] = max(job["maxSliceSeconds"], run_time)
+                yield result
+        except Exception as e:
+            job["error"] = str(e)
+            raise
+        finally:
+            job["wallSeconds"] = time.perf_counter() - started_at
+            if undo_name:
+                change_feed.notify()
+            with self._lock:
+                self.recent_jobs.append(job)
+            if job["slices"] > 1:
+                logger.info("Job %s: %d item(s) in %d slice(s)", job_name, job["items"], job["slices"], extra={"fields": job})
+
+    def new_undo_scope(self, name):
+        return {"name": name, "entry": None, "lastStep": None, "open": False}
+
+    def enter_undo_scope(self, scope):
+        """Make scope the innermost undo scope. Main thread only."""
+        self._undo_scopes.append(scope)
+
+    def exit_undo_scope(self, scope):
+        """Leave scope, merging what was written in it into its entry. Main thread only."""
+        self._undo_scopes.pop()
+        if scope["open"]:
+            scope["open"] = False
+            mw.col.merge_undo_entries(scope["entry"])
+            scope["lastStep"] = mw.col.undo_status().last_step
+
+    def begin_undo(self):
+        """Open the outermost undo scope's entry; call right before each undoable write.
+
+        Nested scopes (a job run inside multi) are folded into the outer one.
+        Main thread only.
+        """
+        if not self._undo_scopes:
+            return
+        scope = self._undo_scopes[0]
+        if not scope["open"]:
+            if scope["entry"] is None or mw.col.undo_status().last_step != scope["lastStep"]:
+                scope["entry"] = mw.col.add_custom_undo_entry(scope["name"])
+            scope["open"] = True
+
+    def fold_undo(self):
+        """Merge the changes made so far into the open undo entry.
+
+        Anki keeps only the last 30 undo steps, so jobs that make one step per
+        note (add_note) fold them in as they go; otherwise the entry would be
+        dropped before the end of the slice. Main thread only.
+        """
+        if self._undo_scopes and self._undo_scopes[0]["open"]:
+            mw.col.merge_undo_entries(self._undo_scopes[0]["entry"])
+
+    def stats(self):
+        with self._lock:
+            return {"sliceSize": self.slice_size, "recentJobs": list(self.recent_jobs)}
+
+scheduler = MainThreadScheduler()
+
+def apply_note_updates(updates, field_indexes=None):
+    """Apply {note_id: (fields, tags)} with one update_notes call; runs on the main thread.
+
+    fields maps field names to new values and tags is a list replacing the
+    note's tags, or None to keep them. Only notes that actually change are
+    written. Returns {note_id: "updated" | "unchanged" | "notFound"}.
+    """
+    field_indexes = {} if field_indexes is None else field_indexes
+    rows = {
+        nid: (mid, flds, tags)
+        for nid, mid, flds, tags in mw.col.db.all(f"select id, mid, flds, tags from notes where id in {ids2str(updates)}")
+    }
+    statuses = {}
+    changed_notes = []
+    for nid, (fields, tags) in updates.items():
+        if nid not in rows:
+            statuses[nid] = "notFound"
+            continue
+        mid, flds, current_tags = rows[nid]
+        if mid not in field_indexes:
+            field_indexes[mid] = {f['name']: idx for idx, f in enumerate(mw.col.models.get(mid)['flds'])}
+        indexes = field_indexes[mid]
+        values = flds.split("\x1f")
+        changes = {name: value for name, value in (fields or {}).items()
+                   if name in indexes and values[indexes[name]] != value}
+        tags_changed = tags is not None and set(mw.col.tags.split(current_tags)) != set(tags)
+        if not changes and not tags_changed:
+            statuses[nid] = "unchanged"
+            continue
+        note = mw.col.get_note(nid)
+        for field_name, field_value in changes.items():
+            note[field_name] = field_value
+        if tags_changed:
+            note.tags = list(tags)
+        changed_notes.append(note)
+        statuses[nid] = "updated"
+    if changed_notes:
+        scheduler.begin_undo()
+        mw.col.update_notes(changed_notes)
+    return statuses
+
+class WriteCoalescer:
+    """Merges single-note field and tag writes that arrive within a short window.
+
+    The first write to arrive waits WRITE_COALESCE_WINDOW seconds, then
+    applies every write queued meanwhile in one main-thread task and one
+    update_notes call; later writes to the same note win field by field.
+    Each caller gets the status of its own note. If the merged call fails,
+    the notes are retried one at a time so that one bad write only fails
+    its own caller.
+    """
+    def __init__(self, window=WRITE_COALESCE_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def submit(self, note_id, fields=None, tags=None):
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = {"writes": {}, "done": Event(), "statuses": None, "error": None}
+            queued_fields, queued_tags = batch["writes"].get(note_id, ({}, None))
+            batch["writes"][note_id] = (dict(queued_fields, **(fields or {})), tags if tags is not None else queued_tags)
+
+        if not leader:
+            batch["done"].wait()
+        else:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self._lock:
+                self._pending = None
+            try:
+                batch["statuses"] = scheduler.run("coalescedWrites", lambda: self._apply(batch["writes"]),
+                                                  undo_name="Apro - Bridge: Update Notes", single_write=True)
+            except Exception as e:
+                batch["error"] = e
+            finally:
+                batch["done"].set()
+
+        if batch["error"] is not None:
+            raise batch["error"]
+        status = batch["statuses"][note_id]
+        if isinstance(status, Exception):
+            raise status
+        return status
+
+    def _apply(self, writes):
+        try:
+            statuses = apply_note_updates(writes)
+        except Exception:
+            if len(writes) == 1:
+                raise
+            statuses = {}
+            for note_id, write in writes.items():
+                try:
+                    statuses.update(apply_note_updates({note_id: write}))
+                except Exception as e:
+                    statuses[note_id] = e
+        updated_count = sum(1 for status in statuses.values() if status == "updated")
+        if updated_count:
+            tooltip(f"✅ Apro - Bridge updated {updated_count} note(s)")
+        return statuses
+
+write_coalescer = WriteCoalescer()
+
+class IdempotencyCache:
+    """Responses of requests sent with an Idempotency-Key header, kept LRU with a TTL.
+
+    A key is claimed while its request runs; a retry with the same key waits
+    for it and then gets the stored response instead of repeating the write.
+    Keys are bound to the method, path and body they were first used with.
+    """
+    def __init__(self, max_entries=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def claim(self, key, fingerprint):
+        """Return (True, None) if the caller should run the request, or (False, stored response)."""
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                entry = self._entries.get(key)
+                if entry is not None and entry["response"] is not None and entry["expires"] < now:
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    self._entries[key] = {"fingerprint": fingerprint, "done": Event(), "response": None, "expires": None}
+                    self._evict()
+                    return True, None
+                if entry["fingerprint"] != fingerprint:
+                    raise ValueError("Idempotency-Key was already used for a different request.")
+                if entry["response"] is not None:
+                    self._entries.move_to_end(key)
+                    return False, entry["response"]
+                done = entry["done"]
+            if not done.wait(max(0.0, deadline - time.monotonic())):
+                raise ValueError("A request with this Idempotency-Key is still in progress.")
+
+    def complete(self, key, response):
+        """Store the response of a claimed key, or release the claim if response is None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if response is None:
+                del self._entries[key]
+            else:
+                entry["response"] = response
+                entry["expires"] = time.monotonic() + self.ttl
+                self._evict()
+            entry["done"].set()
+
+    def _evict(self):
+        # Claims still in progress are never evicted.
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if self._entries[key]["response"] is not None:
+                del self._entries[key]
+
+    def reset(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+idempotency_cache = IdempotencyCache()
+
+def idempotent(do_method):
+    """Wrap a do_* method so requests with an Idempotency-Key are executed at most once.
+
+    Only JSON bodies take part; binary and multipart media uploads are
+    content-addressed and already safe to retry. The response is stored when
+    the request ends (see RequestHandler._end_request), which for a long-poll
+    is after its wait. Only 2xx responses are stored: errors, which may come
+    from a busy or failing collection, and streamed responses are not, so
+    such requests can be retried.
+    """
+    def wrapper(self):
+        key = self.headers.get('Idempotency-Key')
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if not key or content_type not in ('', 'application/json', 'text/plain'):
+            return do_method(self)
+
+        self._body = self._read_body()
+        fingerprint = hashlib.sha1(f"{self.command} {self.path}\n".encode('utf-8') + self._body).hexdigest()
+        try:
+            should_run, response = idempotency_cache.claim(key, fingerprint)
+        except ValueError as e:
+            self._report_error(self.command, e)
+            self._send_error(409, {"error": str(e)})
+            return
+        if not should_run:
+            status_code, body, headers, content_type = response
+            self._metrics_action = 'idempotentReplay'
+            self._send_response(status_code, body, dict(headers, **{'Idempotent-Replayed': 'true'}), content_type)
+            return
+
+        self._idempotency_key = key
+        do_method(self)
+    return wrapper
+
+class ChangeFeed:
+    """Wakes long-polling changesSince requests when notes, tags or note types change.
+
+    Notified by Anki's operation hooks and by the bridge's own write jobs,
+    which do not go through those hooks. Also keeps a log of deleted notes,
+    fed by the notes_will_be_deleted hook. Notes removed by a sync never
+    pass through that hook, so the log starts afresh after every sync.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._listeners = set()
+        self._deleted = deque(maxlen=CHANGES_DELETED_LOG_SIZE) # (second, note ID)
+        self._deleted_since = int(time.time()) # Every deletion from this second on is in the log
+
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def notify(self, *args):
+        with self._lock:
+            self._version += 1
+            listeners, self._listeners = self._listeners, set()
+        for listener in listeners:
+            listener()
+
+    def subscribe(self, version, listener):
+        """Call listener() once, at the first change after version (right away if there was one)."""
+        with self._lock:
+            if self._version == version:
+                self._listeners.add(listener)
+                return
+        listener()
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners.discard(listener)
+
+    def deleted(self, since, upto):
+        """Return (IDs of notes deleted after second since and before upto, whether the log covers that span)."""
+        with self._lock:
+            return [nid for second, nid in self._deleted if since < second < upto], since + 1 >= self._deleted_since
+
+    def on_notes_will_be_deleted(self, col, note_ids):
+        now = int(time.time())
+        with self._lock:
+            for nid in note_ids:
+                if len(self._deleted) == self._deleted.maxlen:
+                    self._deleted_since = max(self._deleted_since, self._deleted[0][0] + 1)
+                self._deleted.append((now, int(nid)))
+        self.notify()
+
+    def on_sync_did_finish(self):
+        with self._lock:
+            self._deleted.clear()
+            self._deleted_since = int(time.time()) + 1
+        self.notify()
+
+    def on_operation_did_execute(self, changes, handler):
+        if getattr(changes, 'note_text', False) or changes.tag or changes.notetype:
+            self.notify()
+
+change_feed = ChangeFeed()
+
+class DuplicateIndex:
+    """Field checksum -> note IDs for each (note type, field) used in duplicate checks.
+
+    Built lazily with one pass over the note type's notes, then refreshed
+    from notes.mod after the bridge's own writes, so checking a batch of
+    candidates costs one dictionary lookup each instead of a search. Notes
+    that arrive by sync or import keep an older mod, so any note change made
+    outside the bridge, a reset or a sync drops the index instead. Hits are
+    verified against the stored field, as Anki's own duplicate check does;
+    notes deleted since are dropped at that point. Only used on the main
+    thread.
+    """
+    def __init__(self):
+        self._entries = {}
+
+    def _entry(self, model, field_ord):
+        key = (model['id'], field_ord)
+        entry = self._entries.get(key)
+        version = change_feed.version()
+        if entry is not None and entry["modelMod"] != model['mod']:
+            entry = None # Fields may have been reordered.
+        if entry is None:
+            entry = self._entries[key] = {"sums": {}, "notes": {}, "mod": 0, "modelMod": model['mod'], "version": None}
+            rows = mw.col.db.all("select id, flds, mod from notes where mid = ?", model['id'])
+        elif entry["version"] != version:
+            rows = mw.col.db.all("select id, flds, mod from notes where mid = ? and mod >= ?", model['id'], entry["mod"])
+        else:
+            return entry
+        for nid, flds, mod in rows:
+            values = flds.split("\x1f")
+            self._set(entry, nid, field_checksum(values[field_ord]) if field_ord < len(values) else None)
+            entry["mod"] = max(entry["mod"], mod)
+        entry["version"] = version
+        return entry
+
+    def _set(self, entry, nid, checksum):
+        previous = entry["notes"].get(nid)
+        if previous == checksum:
+            return
+        if previous is not None:
+            entry["sums"][previous].discard(nid)
+        entry["notes"][nid] = checksum
+        if checksum is not None:
+            entry["sums"].setdefault(checksum, set()).add(nid)
+
+    def find(self, model, field_ord, value):
+        """Return the ID of a note of this type whose field matches value, or None."""
+        if not strip_html_media(value).strip():
+            return None
+        entry = self._entry(model, field_ord)
+        wanted = strip_html_media(value)
+        for nid in sorted(entry["sums"].get(field_checksum(value), ())):
+            flds = mw.col.db.scalar("select flds from notes where id = ? and mid = ?", nid, model['id'])
+            if flds is None:
+                self._set(entry, nid, None)
+                continue
+            values = flds.split("\x1f")
+            if field_ord < len(values) and strip_html_media(values[field_ord]) == wanted:
+                return nid
+        return None
+
+    def add(self, model, nid, values):
+        """Record the field values a note was just given by the bridge."""
+        for (mid, field_ord), entry in self._entries.items():
+            if mid == model['id'] and field_ord < len(values):
+                self._set(entry, nid, field_checksum(values[field_ord]))
+
+    def reset(self, *args):
+        self._entries = {}
+
+    def on_operation_did_execute(self, changes, handler):
+        if getattr(changes, 'note_text', False) or changes.notetype:
+            self.reset()
+
+duplicate_index = DuplicateIndex()
+
+def make_etag(data):
+    return '"' + hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:20] + '"'
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches etag (weak comparison)."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+class CatalogCache:
+    """Deck and note type names served by GET /.
+
+    Built on the main thread on first use and kept until Anki reports a deck
+    or note type change (or the bridge itself creates a deck), so repeated
+    polls cost neither a main-thread hop nor a full decks.all() walk.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entry = None
+        self._generation = 0
+
+    def get(self):
+        """Return (catalog, etag), rebuilding the catalog if it was invalidated."""
+        with self._lock:
+            if self._entry is not None:
+                return self._entry
+            generation = self._generation
+
+        def build_catalog_sync():
+            return {
+                "decks": sorted(d.name for d in mw.col.decks.all_names_and_ids()),
+                "noteTypes": sorted(m.name for m in mw.col.models.all_names_and_ids()),
+            }
+
+        catalog = scheduler.run("catalog", build_catalog_sync)
+        entry = (catalog, make_etag(catalog))
+        with self._lock:
+            # Don't keep a build that raced with an invalidation.
+            if self._generation == generation:
+                self._entry = entry
+        return entry
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+            self._generation += 1
+
+    def check_decks(self, deck_names):
+        """Invalidate if any of deck_names is missing from the cached catalog (i.e. was just created)."""
+        with self._lock:
+            entry = self._entry
+        if entry is not None and not set(deck_names) <= set(entry[0]["decks"]):
+            self.invalidate()
+
+    def on_operation_did_execute(self, changes, handler):
+        if changes.deck or changes.notetype:
+            self.invalidate()
+
+catalog_cache = CatalogCache()
+
+class SearchResultCache:
+    """Sorted note IDs of recent searches, so cursor pages don't re-run the search.
+
+    The first page of a query always searches afresh; follow-up pages reuse
+    the stored result for SEARCH_CURSOR_TTL seconds. Cursors are the last
+    note ID of the previous page, so they stay valid even if the search has
+    to be repeated.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def get(self, query, fresh):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._results.get(query)
+        if not fresh and entry is not None and now - entry[0] < SEARCH_CURSOR_TTL:
+            return entry[1]
+
+        note_ids = scheduler.run("findNotes", lambda: sorted(mw.col.find_notes(query)))
+        with self._lock:
+            self._results[query] = (now, note_ids)
+            if len(self._results) > SEARCH_CURSOR_CACHE_SIZE:
+                oldest = min(self._results, key=lambda q: self._results[q][0])
+                del self._results[oldest]
+        return note_ids
+
+    def reset(self):
+        with self._lock:
+            self._results = {}
+
+search_cache = SearchResultCache()
+
+class ModelSchemaCache:
+    """Compiled /model-fields payloads keyed by note type ID and modification time.
+
+    Fields, every template, all cloze fields and a CSS hash are extracted once
+    per note type revision; a later edit bumps the note type's mod and the
+    entry is rebuilt on the next request.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schemas = {}
+
+    def get(self, model):
+        """Return (schema, etag) for a note type dict."""
+        with self._lock:
+            entry = self._schemas.get(model['id'])
+        if entry is not None and entry[0] == model['mod']:
+            return entry[1], entry[2]
+
+        schema = self._compile(model)
+        etag = make_etag(schema)
+        with self._lock:
+            self._schemas[model['id']] = (model['mod'], schema, etag)
+        return schema, etag
+
+    def _compile(self, model):
+        is_cloze = model['type'] == 1
+        css = model.get('css', '')
+        templates = [
+            {"name": t.get('name', ''), "Front": t.get('qfmt', ''), "Back": t.get('afmt', '')}
+            for t in model.get('tmpls', [])
+        ]
+
+        cloze_field_names = []
+        if is_cloze:
+            for template in templates:
+                for field_name in CLOZE_FIELD_RE.findall(template["Front"] + template["Back"]):
+                    if field_name not in cloze_field_names:
+                        cloze_field_names.append(field_name)
+
+        return {
+            "name": model['name'],
+            "fields": [f['name'] for f in model['flds']],
+            "isCloze": is_cloze,
+            "clozeFieldName": cloze_field_names[0] if cloze_field_names else None,
+            "clozeFieldNames": cloze_field_names,
+            "Front": templates[0]["Front"] if templates else "",
+            "Back": templates[0]["Back"] if templates else "",
+            "CSS": css,
+            "cssHash": hashlib.sha1(css.encode('utf-8')).hexdigest(),
+            "templates": templates,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._schemas = {}
+
+model_schema_cache = ModelSchemaCache()
+
 class RequestHandler(BaseHTTPRequestHandler):
+    # Persistent connections: every response must carry Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Socket timeout while a request is being read; between requests the
+    # connection waits in the server's selector instead.
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body are written separately; with Nagle's algorithm the body
+    # waits for the client's delayed ACK on a kept-alive connection.
+    disable_nagle_algorithm = True
+
+    # POST actions (also usable as steps of 'multi') and their handlers.
+    ACTIONS = {
+        'notesInfo': 'handle_notes_info',
+        'addTags': 'handle_add_tags',
+        'removeTags': 'handle_remove_tags',
+        'updateNoteTags': 'handle_update_note_tags',
+        'updateNotesTags': 'handle_update_notes_tags',
+        'findNotes': 'handle_find_notes',
+        'addNote': 'handle_add_note',
+        'addNotes': 'handle_add_notes',
+        'deleteNotes': 'handle_delete_notes',
+        'updateNotes': 'handle_update_notes',
+        'hasMedia': 'handle_has_media',
+        'changesSince': 'handle_changes_since',
+        'modelFields': 'handle_model_fields',
+    }
+
+    def setup(self):
+        super().setup()
+        self._requests_served = 0
+        self._deferred = None
+
+    def handle(self):
+        """Serve the request that woke this connection and any pipelined behind it.
+
+        A connection that stays open is handed back to the server, which
+        waits for its next request without holding a worker.
+        """
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+            self._handle_pipelined()
+        except BaseException:
+            self._abandon()
+            raise
+
+    def _handle_pipelined(self):
+        while not self.close_connection and self._deferred is None and self._input_pending():
+            self.handle_one_request()
+
+    def serve_next(self, resume=False):
+        """Serve the next request on a kept-open connection, or with resume finish a deferred one."""
+        try:
+            if resume:
+                self._resume()
+            else:
+                self.handle()
+        except BaseException:
+            self._abandon()
+            raise
+        finally:
+            self.finish()
+
+    def _abandon(self):
+        self.close_connection = True
+        if self._deferred is not None:
+            self._deferred = None
+            self._end_request()
+
+    def finish(self):
+        # Kept-open and long-polling connections go back to the server with their files open.
+        if self.server.closing or (self._deferred is None and self.close_connection):
+            self.close()
+
+    def close(self):
+        super().finish()
+
+    def _input_pending(self):
+        # A pipelined request may already sit in rfile's buffer, where the
+        # server's selector cannot see it.
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        self._body_read = False
+        self._body = None
+        self._captured_response = None
+        self._metrics_action = None
+        self._in_batch = False
+        self._deferred = None
+        self._idempotency_key = None
+        self.command = None
+        _request_timing.stages = self._stages = {}
+        self._started_at = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            _request_timing.stages = None
+            if self._deferred is None:
+                self._end_request()
+
+    def _end_request(self):
+        key, self._idempotency_key = self._idempotency_key, None
+        if key is not None:
+            captured = self._captured_response
+            idempotency_cache.complete(key, captured if captured is not None and 200 <= captured[0] < 300 else None)
+        if self.command:
+            self._stages["total"] = time.perf_counter() - self._started_at
+            request_metrics.observe(self._metrics_action or self._default_metrics_action(), self._stages)
+
+    def _defer(self, version, deadline, resume):
+        """Finish this request later without holding a worker.
+
+        The server keeps the connection until the change feed moves past
+        version (and the current second is over) or until deadline, then
+        calls resume() on a worker. resume returns the response body, or
+        None after deferring again.
+        """
+        self._deferred = {"version": version, "deadline": deadline, "resume": resume}
+
+    def _resume(self):
+        deferred, self._deferred = self._deferred, None
+        _request_timing.stages = self._stages
+        try:
+            response = deferred["resume"]()
+            if response is not None:
+                self._send_response(200, response)
+        except Exception as e:
+            self._report_error(self.command, e)
+            self._send_error(400, {"error": str(e)})
+        finally:
+            _request_timing.stages = None
+            if self._deferred is None:
+                self._end_request()
+        self._handle_pipelined()
+
+    def _default_metrics_action(self):
+        path = urlparse(self.path).path
+        if path.startswith('/media/'):
+            path = '/media'
+        elif path not in ('/', '/metrics', '/model-fields'):
+            path = '/other'
+        return f"{self.command} {path}"
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self._requests_served += 1
+        if self._requests_served >= MAX_REQUESTS_PER_CONNECTION:
+            self.send_header('Connection', 'close')
+        elif not self.close_connection:
+            self.send_header('Keep-Alive', f"timeout={KEEP_ALIVE_TIMEOUT}, max={MAX_REQUESTS_PER_CONNECTION - self._requests_served}")
+
+    def _read_body(self):
+        if self._body is not None:
+            return self._body
+        started_at = time.perf_counter()
+        content_length = int(self.headers.get('Content-Length', 0))
+        body_bytes = self.rfile.read(content_length)
+        self._body_read = True
+        record_stage("read", time.perf_counter() - started_at)
+        return body_bytes
+
+    def _read_json(self):
+        body_bytes = self._read_body()
+        started_at = time.perf_counter()
+        data = json.loads(body_bytes)
+        record_stage("parse", time.perf_counter() - started_at)
+        return data
+
+    def _iter_body_chunks(self):
+        if self._body is not None:
+            yield self._body
+            return
+        length_header = self.headers.get('Content-Length')
+        if length_header is None:
+            raise ValueError("Content-Length header is required for binary media uploads.")
+        remaining = int(length_header)
+        while remaining > 0:
+            started_at = time.perf_counter()
+            chunk = self.rfile.read(min(MEDIA_CHUNK_SIZE, remaining))
+            record_stage("read", time.perf_counter() - started_at)
+            if not chunk:
+                raise ValueError("Upload ended before Content-Length bytes were received.")
+            remaining -= len(chunk)
+            yield chunk
+        self._body_read = True
+
+    def _send_connection_header(self):
+        # A request body we never consumed would be parsed as the next request.
+        if not self._body_read and int(self.headers.get('Content-Length') or 0) > 0 and not self.close_connection:
+            self.send_header('Connection', 'close')
+
     def _send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, OPTIONS, PATCH, DELETE')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Methods', 'GET, HEAD, POST, PUT, OPTIONS, PATCH, DELETE')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Media-Extension, If-None-Match, Idempotency-Key')
+        self.send_header('Access-Control-Expose-Headers', 'X-Media-Filename, ETag, X-Next-Cursor, Idempotent-Replayed')
 
     def do_OPTIONS(self):
-        print(f"\n{LOG_PREFIX} Received OPTIONS request for {self.path}")
+        logger.debug("Received %s request for %s", self.command, self.path)
         self.send_response(200)
         self._send_cors_headers()
+        self.send_header('Access-Control-Max-Age', str(CORS_MAX_AGE))
+        self.send_header('Content-Length', '0')
+        self._send_connection_header()
         self.end_headers()
 
+    @idempotent
     def do_DELETE(self):
-        print(f"\n{LOG_PREFIX} Received DELETE request for {self.path}")
+        logger.debug("Received %s request for %s", self.command, self.path)
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            body_bytes = self.rfile.read(content_length)
-            data = json.loads(body_bytes)
-
-            note_id = data.get('noteId')
-            if not note_id:
-                raise ValueError("Request was missing required field 'noteId'.")
-
-            error_container = [None]
-            task_done = Event()
-            def delete_note_sync():
-                try:
-                    mw.col.remove_notes([note_id])
-                    tooltip(f"✅ Apro - Bridge note {note_id} deleted")
-                except Exception as e:
-                    error_container[0] = e
-                finally:
-                    task_done.set()
-
-            mw.taskman.run_on_main(delete_note_sync)
-            task_done.wait()
-
-            if error_container[0]:
-                raise error_container[0]
-
-            self.send_response(200)
-            self._send_cors_headers()
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "success"}).encode('utf-8'))
+            data = self._read_json()
+            params = data.get('params', data)
+
+            if params.get('noteIds') is None and params.get('query') is None:
+                note_id = params.get('noteId')
+                if not note_id:
+                    raise ValueError("Request was missing required field 'noteId', 'noteIds' or 'query'.")
+                self.handle_delete_notes({'noteIds': [note_id]})
+                self._send_response(200, {"status": "success"})
+                return
+
+            self._send_response(200, dict(self.handle_delete_notes(params), status="success"))
         except Exception as e:
-            error_message = traceback.format_exc()
-            mw.taskman.run_on_main(lambda: tooltip(f"Apro - Bridge Connector Error (DELETE):\n{error_message}", period=10000))
+            self._report_error("DELETE", e)
             self._send_error(400, {"error": str(e)})
 
+    @idempotent
     def do_PATCH(self):
-        print(f"\n{LOG_PREFIX} Received PATCH request for {self.path}")
+        logger.debug("Received %s request for %s", self.command, self.path)
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            body_bytes = self.rfile.read(content_length)
-            data = json.loads(body_bytes)
+            data = self._read_json()
 
             note_data = data.get('note') or data.get('params', {}).get('note')
+            notes_data = data.get('notes') or data.get('params', {}).get('notes')
+            if isinstance(note_data, list):
+                notes_data = note_data
+            if notes_data is not None:
+                self._send_response(200, self.handle_patch_notes(notes_data))
+                return
             if not note_data:
                  raise ValueError("Request 'note' structure or 'params.note' structure missing.")
 
@@ -107,58 +1399,114 @@ class RequestHandler(BaseHTTPRequestHandler):
             if fields_data is not None:
                 if not isinstance(fields_data, dict):
                     raise ValueError("'fields' must be an object/dictionary.")
+                if not all(isinstance(value, str) for value in fields_data.values()):
+                    raise ValueError("Field values in 'fields' must be strings.")
 
-                error_container = [None]
-                task_done = Event()
-                def update_note_sync():
-                    try:
-                        note = mw.col.get_note(note_id)
-                        if not note:
-                            raise ValueError(f"Note with ID '{note_id}' not found.")
-
-                        changed_fields = False
-                        for field_name, field_value in fields_data.items():
-                            if field_name in note:
-                                if note[field_name] != field_value:
-                                    note[field_name] = field_value
-                                    changed_fields = True
-
-                        if changed_fields:
-                            mw.col.update_note(note)
-                            tooltip(f"✅ Apro - Bridge note {note_id} fields updated")
-                    except Exception as e:
-                        error_container[0] = e
-                    finally:
-                        task_done.set()
-
-                mw.taskman.run_on_main(update_note_sync)
-                task_done.wait()
-
-                if error_container[0]:
-                    if "not found" in str(error_container[0]):
-                         self._send_error(404, {"error": str(error_container[0]), "status": "not found"})
-                         return
-                    else:
-                        raise error_container[0]
+                # Merged with other writes to this note that arrive at the same time.
+                if write_coalescer.submit(int(note_id), fields=fields_data) == "notFound":
+                    self._send_error(404, {"error": f"Note with ID '{note_id}' not found.", "status": "not found"})
+                    return
             else:
                 pass
 
-            self.send_response(200)
-            self._send_cors_headers()
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"result": None, "error": None}).encode('utf-8'))
+            self._send_response(200, {"result": None, "error": None})
         except Exception as e:
-            error_message = traceback.format_exc()
-            mw.taskman.run_on_main(lambda: tooltip(f"Apro - Bridge Connector Error (PATCH):\n{error_message}", period=10000))
+            self._report_error("PATCH", e)
             self._send_error(400, {"error": str(e)})
 
+    def handle_delete_notes(self, params):
+        """Delete the notes in 'noteIds' or matching 'query' with one remove_notes call.
+
+        With 'dryRun' nothing is deleted and 'removed' is the number of notes
+        that would be.
+        """
+        note_ids = params.get('noteIds')
+        query = params.get('query')
+        dry_run = params.get('dryRun', False) is True
+        if (note_ids is None) == (query is None):
+            raise ValueError("Exactly one of 'noteIds' (a list of note IDs) or 'query' (a string) is required.")
+        if note_ids is not None and not isinstance(note_ids, list):
+            raise ValueError("'noteIds' must be a list of note IDs.")
+        if query is not None and (not isinstance(query, str) or not query.strip()):
+            raise ValueError("'query' must be a non-empty search string.")
+
+        def delete_notes_sync():
+            if query is not None:
+                existing_ids = list(mw.col.find_notes(query))
+            else:
+                existing_ids = mw.col.db.list(f"select id from notes where id in {ids2str(set(int(nid) for nid in note_ids))}")
+            if dry_run or not existing_ids:
+                return len(existing_ids)
+            removed = mw.col.remove_notes(existing_ids).count
+            tooltip(f"✅ Apro - Bridge deleted {removed} note(s)")
+            return removed
+
+        removed = scheduler.run("deleteNotes", delete_notes_sync)
+        return {"result": {"removed": removed, "dryRun": dry_run}, "error": None}
+
+    def handle_update_notes(self, params):
+        return self.handle_patch_notes(params.get('notes'))
+
+    def handle_patch_notes(self, notes_data):
+        if not isinstance(notes_data, list):
+            raise ValueError("'notes' must be a list of {id, fields} objects.")
+
+        # Later updates to the same note are merged into the first one so each
+        # note is compared and written once.
+        updates = {}
+        for note_data in notes_data:
+            if not isinstance(note_data, dict) or not note_data.get('id'):
+                raise ValueError("Each entry in 'notes' needs an 'id'.")
+            fields_data = note_data.get('fields') or {}
+            if not isinstance(fields_data, dict):
+                raise ValueError("'fields' must be an object/dictionary.")
+            updates.setdefault(int(note_data['id']), {}).update(fields_data)
+
+        field_indexes = {}
+        errors = {}
+
+        def patch_notes_sync(chunk):
+            # A slice is written with one update_notes call, so a failure
+            # leaves all of its notes unchanged and earlier slices committed.
+            try:
+                return apply_note_updates({nid: (updates[nid], None) for nid in chunk}, field_indexes)
+            except Exception as e:
+                logger.warning("PATCH of %d note(s) failed: %s", len(chunk), e)
+                for nid in chunk:
+                    errors[nid] = str(e)
+                return {nid: "error" for nid in chunk}
+
+        statuses = {}
+        for chunk_statuses in scheduler.iter_slices("PATCH", list(updates), patch_notes_sync,
+                                                    undo_name="Apro - Bridge: Update Notes", single_write=True):
+            statuses.update(chunk_statuses)
+
+        updated_count = sum(1 for status in statuses.values() if status == "updated")
+        if updated_count:
+            mw.taskman.run_on_main(lambda: tooltip(f"✅ Apro - Bridge updated fields on {updated_count} of {len(statuses)} note(s)"))
+        results = []
+        for note_data in notes_data:
+            nid = int(note_data['id'])
+            results.append({"id": nid, "status": statuses[nid], "error": errors[nid]} if nid in errors else {"id": nid, "status": statuses[nid]})
+        return {"result": results, "error": None}
+
+    @idempotent
     def do_PUT(self):
-        print(f"\n{LOG_PREFIX} Received PUT (media upload) request for {self.path}")
+        logger.debug("Received %s request for %s", self.command, self.path)
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            body_bytes = self.rfile.read(content_length)
-            data = json.loads(body_bytes.decode('utf-8'))
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if urlparse(self.path).path == '/media':
+                self._send_response(200, self.handle_bulk_media(content_type))
+                return
+            if content_type == 'application/octet-stream':
+                # Raw binary upload: the body is the file itself, streamed to disk.
+                query = parse_qs(urlparse(self.path).query)
+                extension = query.get('extension', [None])[0] or self.headers.get('X-Media-Extension', 'unknown')
+                final_filename, _ = write_media_stream(self._iter_body_chunks(), extension)
+                self._send_response(200, {"result": final_filename, "error": None})
+                return
+
+            data = self._read_json()
             b64_data = data.get('mediaData')
             extension = data.get('extension', 'unknown')
 
@@ -168,139 +1516,347 @@ class RequestHandler(BaseHTTPRequestHandler):
             media_bytes = base64.b64decode(b64_data)
             hasher = hashlib.sha1()
             hasher.update(media_bytes)
-            filename = f"apro-bridge-{hasher.hexdigest()}.{extension}"
+            sha1 = hasher.hexdigest()
+            filename = f"apro-bridge-{sha1}.{extension}"
 
-            final_filename = mw.col.media.write_data(filename, media_bytes)
+            if media_index.lookup([sha1], extension)[sha1] == filename:
+                final_filename = filename
+            else:
+                final_filename = mw.col.media.write_data(filename, media_bytes)
+                media_index.add(final_filename)
 
-            self.send_response(200)
-            self._send_cors_headers()
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"result": final_filename, "error": None}).encode('utf-8'))
+            self._send_response(200, {"result": final_filename, "error": None})
         except Exception as e:
-            error_message = traceback.format_exc()
-            mw.taskman.run_on_main(lambda: tooltip(f"Apro - Bridge Connector Error (PUT):\n{error_message}", period=10000))
+            self._report_error("PUT", e)
             self._send_error(500, {"error": str(e)})
 
+    def handle_bulk_media(self, content_type):
+        """Store many media files from a multipart/form-data, zip or JSON body.
+
+        The body is spooled to a temporary file first. Multipart parts are
+        memoryviews into an mmap of it and archive members are read by each
+        worker from its own ZipFile, so decoding, hashing and writing all run
+        on the server's media pool. Returns one {name, filename, skipped,
+        error} entry per input, in input order.
+        """
+        jobs = []
+        views = []
+        readers = {}
+        mapped = None
+        fd, spool_path = tempfile.mkstemp(prefix="apro-bridge-upload-")
+        try:
+            with os.fdopen(fd, 'wb') as spool_file:
+                for chunk in self._iter_body_chunks():
+                    spool_file.write(chunk)
+
+            if content_type == 'multipart/form-data':
+                match = re.search(r'boundary="?([^";]+)"?', self.headers.get('Content-Type', ''))
+                if not match:
+                    raise ValueError("multipart/form-data upload is missing its boundary.")
+                if os.path.getsize(spool_path) == 0:
+                    raise ValueError("Upload body is empty.")
+                with open(spool_path, 'rb') as spool_file:
+                    mapped = mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+                views.append(memoryview(mapped))
+                for headers, body_start, body_end in iter_multipart_parts(mapped, match.group(1).encode('latin-1')):
+                    disposition = headers.get('content-disposition', '')
+                    filename = MULTIPART_FILENAME_RE.search(disposition)
+                    field_name = MULTIPART_NAME_RE.search(disposition)
+                    name = filename.group(1) if filename else (field_name.group(1) if field_name else str(len(jobs)))
+                    extension = headers.get('x-media-extension') or media_extension(filename and filename.group(1))
+                    views.append(views[0][body_start:body_end])
+                    jobs.append((name, lambda body=views[-1], extension=extension: write_media_data(body, extension)))
+            elif content_type in ('application/zip', 'application/x-zip-compressed'):
+                def read_member(info):
+                    reader = readers.get(threading.get_ident())
+                    if reader is None:
+                        reader = readers[threading.get_ident()] = zipfile.ZipFile(spool_path)
+                    extension = media_extension(info.filename)
+                    if info.file_size <= MEDIA_BUFFER_LIMIT:
+                        return write_media_data(reader.read(info), extension)
+                    with reader.open(info) as member:
+                        return write_media_stream(iter(lambda: member.read(MEDIA_CHUNK_SIZE), b""), extension)
+
+                try:
+                    with zipfile.ZipFile(spool_path) as archive:
+                        members = [info for info in archive.infolist() if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+                except zipfile.BadZipFile as e:
+                    raise ValueError(f"Invalid zip archive: {e}")
+                jobs = [(info.filename, lambda info=info: read_member(info)) for info in members]
+            elif content_type == 'application/json':
+                with open(spool_path, 'rb') as spool_file:
+                    data = json.loads(spool_file.read())
+                files = data.get('files') if isinstance(data, dict) else None
+                if not files or not isinstance(files, list) or not all(isinstance(f, dict) and f.get('mediaData') for f in files):
+                    raise ValueError("'files' (a list of {mediaData, extension} objects) is required.")
+                jobs = [(f.get('name', str(index)), lambda f=f: self._store_json_media(f)) for index, f in enumerate(files)]
+            else:
+                raise ValueError("Bulk media uploads must be multipart/form-data, application/zip or application/json.")
+
+            def run_job(job):
+                name, store = job
+                try:
+                    filename, written = store()
+                    return {"name": name, "filename": filename, "skipped": not written, "error": None}
+                except Exception as e:
+                    return {"name": name, "filename": None, "skipped": False, "error": str(e)}
+
+            results = list(self.server.media_pool.map(run_job, jobs))
+        finally:
+            for reader in readers.values():
+                reader.close()
+            # The mmap can only be closed once no view into it is left.
+            for view in reversed(views):
+                view.release()
+            if mapped is not None:
+                mapped.close()
+            os.remove(spool_path)
+
+        stored_count = sum(1 for r in results if r["filename"] and not r["skipped"])
+        if stored_count:
+            mw.taskman.run_on_main(lambda: tooltip(f"✅ Apro - Bridge stored {stored_count} media file(s)"))
+        return {"result": results, "error": None}
+
+    def _store_json_media(self, file_data):
+        """Decode and store one {mediaData, extension} entry of a JSON bulk upload."""
+        extension = file_data.get('extension')
+        if not extension or not isinstance(extension, str):
+            raise ValueError("'extension' is required for each file.")
+        try:
+            data = base64.b64decode(file_data['mediaData'], validate=True)
+        except (TypeError, ValueError):
+            raise ValueError("'mediaData' is not valid base64.")
+        if not data:
+            raise ValueError("'mediaData' is empty.")
+        return write_media_data(data, extension)
+
+    def do_HEAD(self):
+        logger.debug("Received %s request for %s", self.command, self.path)
+        try:
+            parsed_path = urlparse(self.path)
+            query = parse_qs(parsed_path.query)
+            if not parsed_path.path.startswith('/media/'):
+                self._send_head(404)
+                return
+
+            sha1 = parsed_path.path[len('/media/'):]
+            if not SHA1_RE.fullmatch(sha1):
+                raise ValueError("Expected /media/<sha1> with a 40-character hex SHA-1.")
+            filename = media_index.lookup([sha1], query.get('extension', [None])[0])[sha1]
+            if filename:
+                self._send_head(200, {'X-Media-Filename': filename})
+            else:
+                self._send_head(404)
+        except Exception as e:
+            self._report_error("HEAD", e)
+            self._send_head(400)
+
     def do_GET(self):
-        print(f"\n{LOG_PREFIX} Received GET request for {self.path}")
+        logger.debug("Received %s request for %s", self.command, self.path)
         try:
             parsed_path = urlparse(self.path)
             query = parse_qs(parsed_path.query)
             response_data = {}
 
-            if parsed_path.path == '/model-fields':
+            if parsed_path.path == '/metrics':
+                server_stats = self.server.stats()
+                if query.get('format', [''])[0] == 'json' or 'application/json' in self.headers.get('Accept', ''):
+                    response_data = {"result": {"server": server_stats, "mainThread": scheduler.stats(), "requests": request_metrics.to_json()}, "error": None}
+                else:
+                    self._send_response(200, request_metrics.to_prometheus(server_stats).encode('utf-8'),
+                                        content_type='text/plain; version=0.0.4; charset=utf-8')
+                    return
+            elif parsed_path.path == '/model-fields':
                 model_name = query.get('modelName', [None])[0]
                 if not model_name: raise ValueError("modelName parameter is required")
-                model = mw.col.models.by_name(model_name)
+                # Only the lookup needs the collection; compiling and ETag checks stay on this thread.
+                model = scheduler.run("modelFields", lambda: mw.col.models.by_name(model_name))
                 if not model: raise ValueError(f"Model '{model_name}' not found")
 
-                fields = [f['name'] for f in model['flds']]
-                is_cloze = model['type'] == 1
-                cloze_field_name = None
-                front_template = ""
-                back_template = ""
-                css = model.get('css', '')
-
-                templates = model.get('tmpls', [])
-                if templates:
-                    first_template = templates[0]
-                    front_template = first_template.get('qfmt', '')
-                    back_template = first_template.get('afmt', '')
-
-                if is_cloze:
-                    combined_template = front_template + back_template
-                    match = re.search(r"\{\{cloze:(.*?)\}\}", combined_template)
-                    if match:
-                        cloze_field_name = match.group(1)
-
-                response_data = {
-                    "result": {
-                        "name": model['name'],
-                        "fields": fields,
-                        "isCloze": is_cloze,
-                        "clozeFieldName": cloze_field_name,
-                        "Front": front_template,
-                        "Back": back_template,
-                        "CSS": css
-                    },
-                    "error": None
-                }
+                schema, etag = model_schema_cache.get(model)
+                if etag_matches(self.headers.get('If-None-Match'), etag):
+                    self._send_head(304, {'ETag': etag, 'Cache-Control': 'no-cache'})
+                    return
+                self._send_response(200, {"result": schema, "error": None}, {'ETag': etag, 'Cache-Control': 'no-cache'})
+                return
             else:
-                deck_names = sorted([d['name'] for d in mw.col.decks.all()])
-                note_type_names = sorted([m.name for m in mw.col.models.all_names_and_ids()])
-                response_data = {"result": {"decks": deck_names, "noteTypes": note_type_names}, "error": None}
-
-            response_json = json.dumps(response_data)
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            self.wfile.write(response_json.encode('utf-8'))
+                catalog, etag = catalog_cache.get()
+                if etag_matches(self.headers.get('If-None-Match'), etag):
+                    self._send_head(304, {'ETag': etag, 'Cache-Control': 'no-cache'})
+                    return
+                self._send_response(200, {"result": catalog, "error": None}, {'ETag': etag, 'Cache-Control': 'no-cache'})
+                return
+
+            self._send_response(200, response_data)
         except Exception as e:
-            error_message = traceback.format_exc()
-            mw.taskman.run_on_main(lambda: tooltip(f"Apro - Bridge Connector Error (GET):\n{error_message}", period=10000))
+            self._report_error("GET", e)
             self._send_error(500, {"error": str(e)})
 
 
+    @idempotent
     def do_POST(self):
-        print(f"\n{LOG_PREFIX} Received POST request for {self.path}")
+        logger.debug("Received %s request for %s", self.command, self.path)
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            body_bytes = self.rfile.read(content_length)
-            data = json.loads(body_bytes)
+            data = self._read_json()
 
             action = data.get('action')
             params = data.get('params', {})
+            self._metrics_action = action or 'addNote'
 
-            if action == 'notesInfo':
-                self.handle_notes_info(params)
-            elif action == 'addTags':
-                self.handle_add_tags(params)
-            elif action == 'removeTags':
-                self.handle_remove_tags(params)
-            elif action == 'updateNoteTags':
-                self.handle_update_note_tags(params)
-            # --- NEW: Added handler for findNotes ---
-            elif action == 'findNotes':
-                self.handle_find_notes(params)
-            # ----------------------------------------
+            if action == 'multi':
+                response = self.handle_multi(params)
+            elif action in self.ACTIONS:
+                response = getattr(self, self.ACTIONS[action])(params)
             elif action is None and 'deck' in data:
-                self.handle_add_note(data)
+                response = self.handle_add_note(data)
             else:
+                 self._metrics_action = 'unsupported'
                  raise ValueError(f"Unsupported action: {action}")
 
+            # Streaming handlers have already written their response.
+            if response is not None:
+                self._send_response(200, response)
+
         except Exception as e:
-            error_message = traceback.format_exc()
-            mw.taskman.run_on_main(lambda: tooltip(f"Apro - Bridge Connector Error (POST):\n{error_message}", period=10000))
+            self._report_error("POST", e)
             self._send_error(400, {"error": str(e)})
 
-    # --- NEW: Handler for findNotes ---
+    def handle_multi(self, params):
+        """Run an ordered list of sub-actions in a single main-thread task.
+
+        Each step is {"action", "params"}; a params value of {"resultOf": i}
+        is replaced by the result of step i. By default a failing step is
+        reported in its slot and the batch continues; with "atomic": true the
+        first failure rolls back every change made by the batch. A batch that
+        writes undoes as one step; a read-only batch leaves the undo history
+        alone.
+        """
+        steps = params.get('actions')
+        if not steps or not isinstance(steps, list):
+            raise ValueError("'actions' parameter (a list of {action, params} objects) is required for multi.")
+        for step in steps:
+            if not isinstance(step, dict) or step.get('action') not in self.ACTIONS:
+                action = step.get('action') if isinstance(step, dict) else None
+                raise ValueError(f"Unsupported action in multi: {action}")
+            if not isinstance(step.get('params', {}), dict):
+                raise ValueError("Each step's 'params' must be an object.")
+        atomic = params.get('atomic', False) is True
+
+        def resolve(step_params, results):
+            resolved = {}
+            for key, value in step_params.items():
+                if isinstance(value, dict) and set(value) == {'resultOf'}:
+                    index = value['resultOf']
+                    if not isinstance(index, int) or not 0 <= index < len(results):
+                        raise ValueError(f"'resultOf' must refer to an earlier step, got {index!r}.")
+                    if results[index]["error"] is not None:
+                        raise ValueError(f"Step {index} failed, its result is unavailable.")
+                    value = results[index]["result"]
+                resolved[key] = value
+            return resolved
+
+        def multi_sync():
+            # Opened by the first step that writes; steps' own jobs fold into it.
+            undo_scope = scheduler.new_undo_scope("Apro - Bridge: Multi")
+            results = []
+            failed = None
+            scheduler.enter_undo_scope(undo_scope)
+            try:
+                for index, step in enumerate(steps):
+                    try:
+                        step_params = resolve(step.get('params', {}), results)
+                        response = getattr(self, self.ACTIONS[step['action']])(step_params)
+                        results.append({"result": response["result"], "error": None})
+                    except Exception as e:
+                        logger.warning("multi step %d (%s) failed: %s", index, step['action'], e)
+                        results.append({"result": None, "error": str(e)})
+                        if atomic:
+                            failed = index
+                            break
+                    finally:
+                        # Fold each step in as it finishes; Anki keeps only 30 undo steps.
+                        scheduler.fold_undo()
+            finally:
+                scheduler.exit_undo_scope(undo_scope)
+            if failed is not None and undo_scope["entry"] is not None:
+                # The whole batch runs in this task, so the merged entry is the top undo step.
+                changes = mw.col.undo().changes
+                mw.update_undo_actions()
+                gui_hooks.operation_did_execute(changes, None)
+            return results, failed
+
+        self._in_batch = True
+        try:
+            results, failed = scheduler.run_batch("multi", multi_sync)
+        finally:
+            self._in_batch = False
+        if failed is not None:
+            error = ValueError(f"Step {failed} ({steps[failed]['action']}) failed, all changes were rolled back: {results[failed]['error']}")
+            self._report_error("POST", error)
+            self._send_error(400, {"error": str(error), "steps": results})
+            return None
+        return {"result": results, "error": None}
+
     def handle_find_notes(self, params):
         query = params.get('query')
         if query is None or not isinstance(query, str):
              raise ValueError("'query' parameter (a string) is required for findNotes.")
 
-        results_container = [None]
-        error_container = [None]
-        task_done = Event()
-
-        def find_notes_sync():
-            try:
+        if self._is_paginated(params):
+            found_ids, next_cursor = self._page_of_ids(params)
+        else:
+            def find_notes_sync():
                 found_ids = mw.col.find_notes(query)
-                results_container[0] = list(found_ids)
-            except Exception as e:
-                error_container[0] = e
-            finally:
-                task_done.set()
+                return list(found_ids)
+
+            found_ids = scheduler.run("findNotes", find_notes_sync)
+            next_cursor = None
+
+        if self._wants_stream(params):
+            chunks = (found_ids[start:start + STREAM_ID_CHUNK] for start in range(0, len(found_ids), STREAM_ID_CHUNK))
+            self._send_ndjson(chunks, next_cursor)
+            return None
+        elif self._is_paginated(params):
+            return {"result": found_ids, "nextCursor": next_cursor, "error": None}
+        else:
+            return {"result": found_ids, "error": None}
+
+    def _is_paginated(self, params):
+        return params.get('limit') is not None or params.get('cursor') is not None
+
+    def _wants_stream(self, params):
+        if self._in_batch:
+            return False
+        return params.get('stream') is True or NDJSON_CONTENT_TYPE in self.headers.get('Accept', '')
+
+    def _page_of_ids(self, params):
+        """Return (note IDs of the requested page, cursor of the next page or None).
+
+        With 'query' the IDs are the ascending search result and the cursor is
+        the last ID of the previous page; with an explicit 'notes' list the
+        cursor is an offset into that list.
+        """
+        limit = params.get('limit')
+        cursor = params.get('cursor')
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+            raise ValueError("'limit' must be a positive integer.")
+        if cursor is not None and not (isinstance(cursor, str) and cursor.isdigit()):
+            raise ValueError("'cursor' must be a value returned as 'nextCursor'.")
+
+        if params.get('query') is not None:
+            if not isinstance(params['query'], str):
+                raise ValueError("'query' parameter must be a string.")
+            note_ids = search_cache.get(params['query'], fresh=cursor is None)
+            start = bisect.bisect_right(note_ids, int(cursor)) if cursor is not None else 0
+            page = note_ids[start:start + limit] if limit else note_ids[start:]
+            has_more = limit is not None and start + limit < len(note_ids)
+            return page, str(page[-1]) if has_more else None
 
-        mw.taskman.run_on_main(find_notes_sync)
-        task_done.wait()
-
-        if error_container[0]:
-            raise error_container[0]
-
-        self._send_response(200, {"result": results_container[0], "error": None})
+        note_ids = params.get('notes')
+        start = int(cursor) if cursor is not None else 0
+        page = note_ids[start:start + limit] if limit else note_ids[start:]
+        has_more = limit is not None and start + limit < len(note_ids)
+        return page, str(start + limit) if has_more else None
 
 
     def handle_update_note_tags(self, params):
@@ -313,75 +1869,124 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         if note_id is None or tags_str is None:
              raise ValueError("'note.id' and 'note.tags' (space-separated string) are required.")
+        if not isinstance(tags_str, str):
+            raise ValueError("'note.tags' must be a space-separated string.")
+
+        if self._in_batch:
+            counts = self._replace_tags("updateNoteTags", {int(note_id): tags_str.split()})
+            if counts["changed"]:
+                mw.taskman.run_on_main(lambda: tooltip(f"✅ Apro - Bridge tags updated for note {note_id}"))
+        else:
+            status = write_coalescer.submit(int(note_id), tags=tags_str.split())
+            counts = {"changed": int(status == "updated"), "unchanged": int(status == "unchanged"), "notFound": int(status == "notFound")}
+        if counts["notFound"]:
+            raise ValueError(f"Note {note_id} not found during updateNoteTags.")
+        return {"result": counts, "error": None}
+
+    def handle_update_notes_tags(self, params):
+        notes_data = params.get('notes')
+        if not notes_data or not isinstance(notes_data, list):
+            raise ValueError("'notes' parameter (a list of {id, tags} objects) is required for updateNotesTags.")
+
+        new_tags = {}
+        for note_data in notes_data:
+            if not isinstance(note_data, dict) or note_data.get('id') is None or not isinstance(note_data.get('tags'), str):
+                raise ValueError("Each entry in 'notes' needs 'id' and 'tags' (space-separated string).")
+            new_tags[int(note_data['id'])] = note_data['tags'].split()
+
+        counts = self._replace_tags("updateNotesTags", new_tags)
+        mw.taskman.run_on_main(lambda: tooltip(f"✅ Apro - Bridge updated tags on {counts['changed']} of {len(new_tags)} note(s)"))
+        return {"result": counts, "error": None}
+
+    def _replace_tags(self, job_name, new_tags):
+        """Replace the tags of each note in {note_id: [tags]}, writing only notes whose tag set changes."""
+        def replace_tags_sync(chunk):
+            current_tags = dict(mw.col.db.all(f"select id, tags from notes where id in {ids2str(chunk)}"))
+            changed_notes = []
+            for nid in chunk:
+                if nid not in current_tags:
+                    continue
+                if set(mw.col.tags.split(current_tags[nid])) != set(new_tags[nid]):
+                    note = mw.col.get_note(nid)
+                    note.tags = new_tags[nid]
+                    changed_notes.append(note)
+            if changed_notes:
+                scheduler.begin_undo()
+                mw.col.update_notes(changed_notes)
+            return len(changed_notes), len(current_tags)
 
-        new_tags_list = tags_str.split()
-        error_container = [None]
-        task_done = Event()
-
-        def update_tags_sync():
-            try:
-                note = mw.col.get_note(note_id)
-                if not note:
-                    raise ValueError(f"Note {note_id} not found during updateNoteTags.")
-
-                current_tags_set = set(note.tags)
-                new_tags_set = set(new_tags_list)
-
-                if current_tags_set != new_tags_set:
-                    note.tags = new_tags_list
-                    mw.col.update_note(note)
-                    tooltip(f"✅ Apro - Bridge tags updated for note {note_id}")
-            except Exception as e:
-                error_container[0] = e
-            finally:
-                task_done.set()
-
-        mw.taskman.run_on_main(update_tags_sync)
-        task_done.wait()
+        counts = scheduler.run_sliced(job_name, list(new_tags), replace_tags_sync, undo_name="Apro - Bridge: Update Tags", single_write=True)
+        return self._tag_counts(len(new_tags), counts)
 
-        if error_container[0]:
-            raise error_container[0]
+    def _tag_counts(self, requested, slice_counts):
+        changed = sum(c for c, _ in slice_counts)
+        found = sum(f for _, f in slice_counts)
+        return {"changed": changed, "unchanged": found - changed, "notFound": requested - found}
 
-        self._send_response(200, {"result": None, "error": None})
-    
     def handle_notes_info(self, params):
         note_ids = params.get('notes')
-        if not note_ids or not isinstance(note_ids, list):
-            raise ValueError("'notes' parameter (a list of note IDs) is required for notesInfo.")
-
-        results_container = [None]
-        error_container = [None]
-        task_done = Event()
-
-        def get_notes_info_sync():
-            try:
-                results = []
-                for nid in note_ids:
-                    note = mw.col.get_note(nid)
-                    if note:
-                        note.load()
-                        results.append({
-                            "noteId": note.id,
-                            "tags": note.tags,
-                            "fields": { fn: {"value": fv, "order": idx} for idx, (fn, fv) in enumerate(note.items())},
-                            "modelName": note.note_type()['name'],
-                            "cards": mw.col.card_ids_of_note(nid)
-                        })
-                    else:
-                        results.append(None)
-                results_container[0] = results
-            except Exception as e:
-                error_container[0] = e
-            finally:
-                task_done.set()
-
-        mw.taskman.run_on_main(get_notes_info_sync)
-        task_done.wait()
-
-        if error_container[0]:
-            raise error_container[0]
-
-        self._send_response(200, {"result": results_container[0], "error": None})
+        if params.get('query') is None and (not note_ids or not isinstance(note_ids, list)):
+            raise ValueError("'notes' parameter (a list of note IDs) or 'query' is required for notesInfo.")
+
+        field_names = params.get('fields')
+        if field_names is not None and (not isinstance(field_names, list) or not all(isinstance(f, str) for f in field_names)):
+            raise ValueError("'fields' parameter must be a list of field names.")
+
+        next_cursor = None
+        if self._is_paginated(params) or params.get('query') is not None:
+            note_ids, next_cursor = self._page_of_ids(params)
+
+        slices = scheduler.iter_slices("notesInfo", note_ids, lambda chunk: self._collect_notes_info(chunk, field_names))
+        if self._wants_stream(params):
+            self._send_ndjson(slices, next_cursor)
+            return None
+
+        results = []
+        for chunk_results in slices:
+            results.extend(chunk_results)
+
+        if self._is_paginated(params):
+            return {"result": results, "nextCursor": next_cursor, "error": None}
+        else:
+            return {"result": results, "error": None}
+
+    def _collect_notes_info(self, note_ids, field_names=None):
+        """Build notesInfo entries for note_ids (None for missing notes) with set-based queries."""
+        note_ids = [int(nid) for nid in note_ids]
+        rows = {
+            nid: (mid, tags, flds)
+            for nid, mid, tags, flds in mw.col.db.all(f"select id, mid, tags, flds from notes where id in {ids2str(set(note_ids))}")
+        }
+        card_ids = {}
+        for nid, cid in mw.col.db.all(f"select nid, id from cards where nid in {ids2str(rows)} order by nid, ord"):
+            card_ids.setdefault(nid, []).append(cid)
+
+        wanted = set(field_names) if field_names is not None else None
+        note_types = {}
+        results = []
+        for nid in note_ids:
+            row = rows.get(nid)
+            if row is None:
+                results.append(None)
+                continue
+
+            mid, tags, flds = row
+            if mid not in note_types:
+                model = mw.col.models.get(mid)
+                note_types[mid] = (
+                    model['name'],
+                    [(idx, f['name']) for idx, f in enumerate(model['flds']) if wanted is None or f['name'] in wanted],
+                )
+            model_name, model_fields = note_types[mid]
+            values = flds.split("\x1f")
+            results.append({
+                "noteId": nid,
+                "tags": mw.col.tags.split(tags),
+                "fields": {fn: {"value": values[idx] if idx < len(values) else "", "order": idx} for idx, fn in model_fields},
+                "modelName": model_name,
+                "cards": card_ids.get(nid, [])
+            })
+        return results
 
     def handle_add_tags(self, params):
         note_ids = params.get('notes')
@@ -391,42 +1996,24 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         tags_to_add = tags_str.split()
         if not tags_to_add:
-             self._send_response(200, {"result": None, "error": None})
-             return
-
-        error_container = [None]
-        notes_changed_count = [0]
-        task_done = Event()
-
-        def add_tags_sync():
-            try:
-                notes_processed = 0
-                for nid in note_ids:
-                    note = mw.col.get_note(nid)
-                    if not note: continue
-
-                    note_changed = False
-                    for tag in tags_to_add:
-                        if note.add_tag(tag): note_changed = True
-
-                    if note_changed:
-                        mw.col.update_note(note)
-                        notes_changed_count[0] += 1
-                    notes_processed += 1
+             return {"result": None, "error": None}
 
-                tooltip(f"✅ Apro - Bridge updated tags on {notes_changed_count[0]} of {notes_processed} note(s)")
-            except Exception as e:
-                error_container[0] = e
-            finally:
-                task_done.set()
+        wanted = {tag.lower() for tag in tags_to_add}
 
-        mw.taskman.run_on_main(add_tags_sync)
-        task_done.wait()
+        def add_tags_sync(chunk):
+            rows = mw.col.db.all(f"select id, tags from notes where id in {ids2str(chunk)}")
+            missing = [nid for nid, tags in rows if not wanted <= {tag.lower() for tag in mw.col.tags.split(tags)}]
+            if not missing:
+                return 0, len(rows)
+            scheduler.begin_undo()
+            return mw.col.tags.bulk_add(missing, " ".join(tags_to_add)).count, len(rows)
 
-        if error_container[0]:
-            raise error_container[0]
+        note_ids = list(dict.fromkeys(int(nid) for nid in note_ids))
+        counts = self._tag_counts(len(note_ids), scheduler.run_sliced("addTags", note_ids, add_tags_sync,
+                                                                       undo_name="Apro - Bridge: Add Tags", single_write=True))
+        mw.taskman.run_on_main(lambda: tooltip(f"✅ Apro - Bridge updated tags on {counts['changed']} of {counts['changed'] + counts['unchanged']} note(s)"))
 
-        self._send_response(200, {"result": None, "error": None})
+        return {"result": counts, "error": None}
 
     def handle_remove_tags(self, params):
         note_ids = params.get('notes')
@@ -436,42 +2023,24 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         tags_to_remove = tags_str.split()
         if not tags_to_remove:
-             self._send_response(200, {"result": None, "error": None})
-             return
+             return {"result": None, "error": None}
 
-        error_container = [None]
-        notes_changed_count = [0]
-        task_done = Event()
-
-        def remove_tags_sync():
-            try:
-                notes_processed = 0
-                for nid in note_ids:
-                    note = mw.col.get_note(nid)
-                    if not note: continue
-
-                    note_changed = False
-                    for tag in tags_to_remove:
-                        if tag in note.tags:
-                             note.remove_tag(tag)
-                             note_changed = True
-
-                    if note_changed:
-                        mw.col.update_note(note)
-                        notes_changed_count[0] += 1
-                    notes_processed += 1
-                tooltip(f"✅ Apro - Bridge updated tags on {notes_changed_count[0]} of {notes_processed} note(s)")
-            except Exception as e:
-                error_container[0] = e
-            finally:
-                task_done.set()
+        # Matches tags the way Anki's removal does: ignoring case, with '*' wildcards and child tags.
+        matcher = re.compile("(?:%s)(?:::|$)" % "|".join(re.escape(tag).replace(r"\*", ".*") for tag in tags_to_remove), re.IGNORECASE)
 
-        mw.taskman.run_on_main(remove_tags_sync)
-        task_done.wait()
+        def remove_tags_sync(chunk):
+            rows = mw.col.db.all(f"select id, tags from notes where id in {ids2str(chunk)}")
+            tagged = [nid for nid, tags in rows if any(matcher.match(tag) for tag in mw.col.tags.split(tags))]
+            if not tagged:
+                return 0, len(rows)
+            scheduler.begin_undo()
+            return mw.col.tags.bulk_remove(tagged, " ".join(tags_to_remove)).count, len(rows)
 
-        if error_container[0]:
-            raise error_container[0]
-        self._send_response(200, {"result": None, "error": None})
+        note_ids = list(dict.fromkeys(int(nid) for nid in note_ids))
+        counts = self._tag_counts(len(note_ids), scheduler.run_sliced("removeTags", note_ids, remove_tags_sync,
+                                                                       undo_name="Apro - Bridge: Remove Tags", single_write=True))
+        mw.taskman.run_on_main(lambda: tooltip(f"✅ Apro - Bridge updated tags on {counts['changed']} of {counts['changed'] + counts['unchanged']} note(s)"))
+        return {"result": counts, "error": None}
 
     def handle_add_note(self, data):
         deck_name = data.get('deck')
@@ -482,61 +2051,607 @@ class RequestHandler(BaseHTTPRequestHandler):
         if not all([deck_name, model_name, fields_data]):
             raise ValueError("Request was missing required fields (deck, noteType, or fields).")
 
-        note_id_container = [None]
-        error_container = [None]
-        task_done = Event()
+        duplicate_mode, duplicate_field = self._duplicate_options(data)
 
         def add_note_sync():
-            try:
-                model = mw.col.models.by_name(model_name)
-                if not model: raise ValueError(f"Note Type '{model_name}' not found in Anki.")
-                note = Note(mw.col, model)
-                for field_name, field_value in fields_data.items():
-                    if field_name in note: note[field_name] = field_value
-                if isinstance(tags_list, list):
-                    for tag in tags_list:
-                        if isinstance(tag, str): note.add_tag(tag.strip())
-                did = mw.col.decks.id(deck_name)
-                mw.col.add_note(note, did)
-                note_id_container[0] = note.id
+            model = mw.col.models.by_name(model_name)
+            if not model: raise ValueError(f"Note Type '{model_name}' not found in Anki.")
+            note_id, status = self._store_note(model, deck_name, mw.col.decks.id, fields_data, tags_list, duplicate_mode, duplicate_field)
+            if status == "created":
                 tooltip(f"✅ Apro - Bridge note added to {deck_name}")
-            except Exception as e:
-                error_container[0] = e
-            finally:
-                task_done.set()
+            return note_id, status
+
+        note_id, status = scheduler.run("addNote", add_note_sync)
+        change_feed.notify()
+        catalog_cache.check_decks([deck_name])
+        if duplicate_mode == 'allow':
+            return {"result": note_id, "error": None}
+        return {"result": {"noteId": note_id, "status": status}, "error": None}
+
+    def _duplicate_options(self, data, defaults=('allow', None)):
+        duplicate_mode = data.get('duplicateMode', defaults[0])
+        duplicate_field = data.get('duplicateField', defaults[1])
+        if duplicate_mode not in ('allow', 'skip', 'upsert'):
+            raise ValueError("'duplicateMode' must be 'allow', 'skip' or 'upsert'.")
+        if duplicate_field is not None and not isinstance(duplicate_field, str):
+            raise ValueError("'duplicateField' must be a field name.")
+        return duplicate_mode, duplicate_field
+
+    def _store_note(self, model, deck_name, deck_id, fields_data, tags_list, duplicate_mode, duplicate_field):
+        """Add a note, or with 'skip'/'upsert' reuse the note of this type with the same key field.
+
+        Returns (note ID, "created" | "skipped" | "updated" | "unchanged").
+        Upserts update the given fields and add the given tags; the existing
+        cards stay in their decks. Runs on the main thread.
+        """
+        if duplicate_mode != 'allow':
+            field_names = [f['name'] for f in model['flds']]
+            key_field = duplicate_field or field_names[0]
+            if key_field not in field_names:
+                raise ValueError(f"Field '{key_field}' not found in Note Type '{model['name']}'.")
+            field_ord = field_names.index(key_field)
+            existing_id = duplicate_index.find(model, field_ord, fields_data.get(key_field, ''))
+            if existing_id is not None:
+                if duplicate_mode == 'skip':
+                    return existing_id, "skipped"
+                tags = None
+                if isinstance(tags_list, list) and tags_list:
+                    current_tags = mw.col.tags.split(mw.col.db.scalar("select tags from notes where id = ?", existing_id))
+                    tags = current_tags + [t.strip() for t in tags_list if isinstance(t, str) and t.strip() and t.strip() not in current_tags]
+                status = apply_note_updates({existing_id: (fields_data, tags)})[existing_id]
+                scheduler.fold_undo()
+                if status == "updated":
+                    duplicate_index.add(model, existing_id, mw.col.get_note(existing_id).fields)
+                return existing_id, status
+
+        note = self._build_note(model, fields_data, tags_list)
+        scheduler.begin_undo()
+        mw.col.add_note(note, deck_id(deck_name))
+        scheduler.fold_undo()
+        duplicate_index.add(model, note.id, note.fields)
+        return note.id, "created"
+
+    def handle_add_notes(self, params):
+        notes_data = params.get('notes')
+        if not notes_data or not isinstance(notes_data, list):
+            raise ValueError("'notes' parameter (a list of note objects) is required for addNotes.")
+        batch_options = self._duplicate_options(params)
+
+        def add_notes_sync():
+            # Resolve each note type and deck once per batch.
+            models = {}
+            deck_ids = {}
+            results = []
+            added_count = 0
+
+            def deck_id(deck_name):
+                if deck_name not in deck_ids:
+                    deck_ids[deck_name] = mw.col.decks.id(deck_name)
+                return deck_ids[deck_name]
+
+            for note_data in notes_data:
+                try:
+                    if not isinstance(note_data, dict):
+                        raise ValueError("Each entry in 'notes' must be an object.")
+                    deck_name = note_data.get('deck')
+                    model_name = note_data.get('noteType')
+                    fields_data = note_data.get('fields')
+                    if not all([deck_name, model_name, fields_data]):
+                        raise ValueError("Note was missing required fields (deck, noteType, or fields).")
+
+                    if model_name not in models:
+                        models[model_name] = mw.col.models.by_name(model_name)
+                    model = models[model_name]
+                    if not model: raise ValueError(f"Note Type '{model_name}' not found in Anki.")
+
+                    duplicate_mode, duplicate_field = self._duplicate_options(note_data, batch_options)
+                    note_id, status = self._store_note(model, deck_name, deck_id, fields_data, note_data.get('tags', []),
+                                                       duplicate_mode, duplicate_field)
+                    results.append({"noteId": note_id, "status": status, "error": None})
+                    if status == "created":
+                        added_count += 1
+                except Exception as e:
+                    results.append({"noteId": None, "status": None, "error": str(e)})
+
+            tooltip(f"✅ Apro - Bridge added {added_count} of {len(notes_data)} note(s)")
+            return results
+
+        results = scheduler.run("addNotes", add_notes_sync, undo_name="Apro - Bridge: Add Notes")
+        catalog_cache.check_decks({n.get('deck') for n in notes_data if isinstance(n, dict) and n.get('deck')})
+        return {"result": results, "error": None}
+
+    def handle_changes_since(self, params):
+        """Return notes, their tags and note types modified after the 'since' watermark.
+
+        'since' is a note modification time in seconds (0 for everything).
+        Notes come in (mod, id) order, 'limit' per page; while 'nextCursor'
+        is set the client should keep paging, and the last page carries the
+        new 'watermark'. With 'wait' an empty first page is held open, off
+        the worker pool, until something changes or the wait runs out.
+        """
+        if params.get('usn') is not None:
+            raise ValueError("USN watermarks are not supported; pass 'since' (a note modification time in seconds).")
+        since = params.get('since', 0)
+        limit = params.get('limit', CHANGES_PAGE_SIZE)
+        wait = params.get('wait', 0)
+        cursor = params.get('cursor')
+        field_names = params.get('fields')
+        if not isinstance(since, int) or isinstance(since, bool) or since < 0:
+            raise ValueError("'since' must be a watermark returned by changesSince, or 0.")
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+            raise ValueError("'limit' must be a positive integer.")
+        if not isinstance(wait, (int, float)) or isinstance(wait, bool) or wait < 0:
+            raise ValueError("'wait' must be a number of seconds.")
+        if field_names is not None and (not isinstance(field_names, list) or not all(isinstance(f, str) for f in field_names)):
+            raise ValueError("'fields' parameter must be a list of field names.")
+        if cursor is not None:
+            parts = cursor.split(':') if isinstance(cursor, str) else []
+            if len(parts) != 3 or not all(part.isdigit() for part in parts):
+                raise ValueError("'cursor' must be a value returned as 'nextCursor'.")
+            cursor = tuple(int(part) for part in parts)
+
+        # Never hold the main thread inside a multi batch.
+        deadline = time.monotonic() + (0 if self._in_batch else min(wait, CHANGES_MAX_WAIT))
+
+        def poll():
+            version = change_feed.version()
+            changes = scheduler.run("changesSince", lambda: self._collect_changes(since, cursor, limit, field_names))
+            if changes["notes"] or changes["models"] or changes["deleted"] or cursor is not None or time.monotonic() >= deadline:
+                return {"result": changes, "error": None}
+            self._defer(version, deadline, poll)
+            return None
+
+        return poll()
+
+    def _collect_changes(self, since, cursor, limit, field_names):
+        # Notes modified in the current second are left for the next call, so
+        # a later edit within the same second cannot slip under the watermark.
+        if cursor is None:
+            upto = int(time.time())
+            rows = mw.col.db.all("select id, mod from notes where mod > ? and mod < ? order by mod, id limit ?", since, upto, limit + 1)
+        else:
+            upto, after_mod, after_id = cursor
+            rows = mw.col.db.all("select id, mod from notes where mod < ? and (mod > ? or (mod = ? and id > ?)) order by mod, id limit ?",
+                                 upto, after_mod, after_mod, after_id, limit + 1)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        notes = self._collect_notes_info([nid for nid, _ in rows], field_names) if rows else []
+        for info, (_, mod) in zip(notes, rows):
+            info["mod"] = mod
+
+        # Note types and deletions cover the whole window, so they come with the first page.
+        models = []
+        deleted, deleted_complete = [], True
+        if cursor is None:
+            models = [{"id": mid, "name": name, "mod": mod} for mid, name, mod in mw.col.db.all(
+                "select id, name, mtime_secs from notetypes where mtime_secs > ? and mtime_secs < ? order by id", since, upto)]
+            deleted, deleted_complete = change_feed.deleted(since, upto)
+
+        return {
+            "notes": [info for info in notes if info is not None],
+            "tags": sorted({tag for info in notes if info is not None for tag in info["tags"]}),
+            "models": models,
+            "deleted": deleted,
+            "deletedComplete": deleted_complete,
+            "nextCursor": f"{upto}:{rows[-1][1]}:{rows[-1][0]}" if has_more else None,
+            "watermark": None if has_more else max(since, upto - 1),
+        }
+
+    def handle_has_media(self, params):
+        hashes = params.get('hashes')
+        if not isinstance(hashes, list) or not all(isinstance(h, str) and SHA1_RE.fullmatch(h) for h in hashes):
+            raise ValueError("'hashes' parameter (a list of SHA-1 hex strings) is required for hasMedia.")
+        extension = params.get('extension')
+
+        # Served from the media index on this thread; no collection access needed.
+        return {"result": media_index.lookup(hashes, extension), "error": None}
+
+    def handle_model_fields(self, params):
+        model_names = params.get('modelNames')
+        if not model_names or not isinstance(model_names, list) or not all(isinstance(n, str) for n in model_names):
+            raise ValueError("'modelNames' parameter (a list of note type names) is required for modelFields.")
+        known_etags = params.get('etags') or {}
+        if not isinstance(known_etags, dict):
+            raise ValueError("'etags' must be an object mapping note type names to ETags.")
+
+        # One main-thread hop for every name; the schema cache and ETag checks
+        # run here. Note types the client already has at this revision come
+        # back as {etag, notModified} without their templates and CSS.
+        models = scheduler.run("modelFields", lambda: {name: mw.col.models.by_name(name) for name in model_names})
+        results = {}
+        for model_name in model_names:
+            model = models[model_name]
+            if not model:
+                results[model_name] = None
+                continue
+            schema, etag = model_schema_cache.get(model)
+            if etag_matches(known_etags.get(model_name), etag):
+                results[model_name] = {"etag": etag, "notModified": True}
+            else:
+                results[model_name] = dict(schema, etag=etag)
+
+        return {"result": results, "error": None}
+
+    def _build_note(self, model, fields_data, tags_list):
+        note = Note(mw.col, model)
+        for field_name, field_value in fields_data.items():
+            if field_name in note: note[field_name] = field_value
+        if isinstance(tags_list, list):
+            for tag in tags_list:
+                if isinstance(tag, str): note.add_tag(tag.strip())
+        return note
+
+    def _send_response(self, status_code, data, headers=None, content_type='application/json'):
+        started_at = time.perf_counter()
+        body = data if isinstance(data, bytes) else dump_json(data)
+        written_at = time.perf_counter()
+        record_stage("serialize", written_at - started_at)
+
+        headers = dict(headers or {})
+        if self._captured_response is None and self.headers.get('Idempotency-Key'):
+            self._captured_response = (status_code, body, dict(headers), content_type)
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding')) if len(body) >= COMPRESSION_MIN_SIZE else None
+        if encoding:
+            compressor = make_compressor(encoding)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = encoding
+            # The compressed bytes are a different representation of the same entity.
+            if 'ETag' in headers and not headers['ETag'].startswith('W/'):
+                headers['ETag'] = 'W/' + headers['ETag']
+            compressed_at = time.perf_counter()
+            record_stage("compress", compressed_at - written_at)
+            written_at = compressed_at
 
-        mw.taskman.run_on_main(add_note_sync)
-        task_done.wait()
+        self.send_response(status_code)
+        self._send_cors_headers()
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self._send_connection_header()
+        self.end_headers()
+        self.wfile.write(body)
+        record_stage("write", time.perf_counter() - written_at)
+
+    def _send_ndjson(self, chunks, next_cursor=None):
+        """Stream lists of items as newline-delimited JSON, one chunk per list.
+
+        HTTP/1.1 clients get chunked transfer encoding; HTTP/1.0 clients get
+        a body delimited by closing the connection. The next page cursor, if
+        any, is sent up front in an X-Next-Cursor header. An error after the
+        headers went out is reported as a final {"error": ...} line. With a
+        gzip/deflate Accept-Encoding the stream is compressed and flushed
+        after every chunk.
+        """
+        chunked = self.request_version != 'HTTP/1.0'
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        compressor = make_compressor(encoding) if encoding else None
+        self.send_response(200)
+        self._send_cors_headers()
+        self.send_header('Content-Type', NDJSON_CONTENT_TYPE)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if next_cursor is not None:
+            self.send_header('X-Next-Cursor', next_cursor)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self._send_connection_header()
+        self.end_headers()
 
-        if error_container[0]: raise error_container[0]
-        self._send_response(200, {"result": note_id_container[0], "error": None})
+        def write(data, flush_mode=zlib.Z_SYNC_FLUSH):
+            if compressor is not None:
+                started_at = time.perf_counter()
+                data = compressor.compress(data) + compressor.flush(flush_mode)
+                record_stage("compress", time.perf_counter() - started_at)
+            if not data:
+                return # An empty chunk would end a chunked body.
+            started_at = time.perf_counter()
+            if chunked:
+                self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+            record_stage("write", time.perf_counter() - started_at)
 
-    def _send_response(self, status_code, data):
+        try:
+            for items in chunks:
+                if not items:
+                    continue
+                started_at = time.perf_counter()
+                data = b"".join(dump_json(item) + b"\n" for item in items)
+                record_stage("serialize", time.perf_counter() - started_at)
+                write(data)
+        except Exception as e:
+            logger.error("Streaming %s failed: %s", self.path, e, exc_info=e)
+            write(dump_json({"error": str(e)}) + b"\n")
+        if compressor is not None:
+            write(b"", zlib.Z_FINISH)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _send_head(self, status_code, headers=None):
         self.send_response(status_code)
         self._send_cors_headers()
-        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status_code != 304:
+            self.send_header('Content-Length', '0')
+        self._send_connection_header()
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
 
     def _send_error(self, status_code, error_data):
         if "error" not in error_data: error_data = {"error": str(error_data)}
         error_data["result"] = None
         self._send_response(status_code, error_data)
 
+    def _report_error(self, method, error):
+        logger.error("%s %s failed: %s", self.command, self.path, error, exc_info=error,
+                     extra={"fields": {"method": self.command, "path": self.path, "action": self._metrics_action}})
+        error_notifier.notify(method, error)
+
+    def log_request(self, code='-', size='-'):
+        logger.info("%s %s %s", self.command, self.path, code, extra={"fields": {
+            "client": self.client_address[0], "method": self.command, "path": self.path,
+            "action": self._metrics_action, "status": int(code) if str(code).isdigit() else str(code)}})
+
     def log_message(self, format, *args):
-        print(f"{LOG_PREFIX} HTTP: {format % args}")
+        logger.warning("HTTP: %s", format % args)
+
+class _Connection:
+    """A client socket and, once it has sent a request, the handler serving it."""
+    def __init__(self, request, client_address):
+        self.request = request
+        self.client_address = client_address
+        self.handler = None
+        self.idle_until = None
+        self.resume_at = None
+        self.listener = None
+
+class BridgeHTTPServer(HTTPServer):
+    """HTTPServer that serves requests on a bounded worker pool.
+
+    Connections waiting for a request, new or kept alive, sit in a selector
+    watched by one thread and take a worker only once a request arrives, so
+    idle clients cannot starve the pool. Collection work still funnels
+    through mw.taskman.run_on_main, so only media and HTTP I/O actually run
+    in parallel; the pool keeps a slow upload from blocking every other
+    client.
+    """
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS, max_in_flight=MAX_IN_FLIGHT):
+        super().__init__(server_address, handler_class)
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="apro-bridge")
+        self.media_pool = ThreadPoolExecutor(max_workers=MEDIA_INGEST_WORKERS, thread_name_prefix="apro-bridge-media")
+        self._stats_lock = threading.Lock()
+        self.in_flight = 0
+        self.active = 0
+        self.served = 0
+        self.rejected = 0
+
+        self.closing = False
+        self._idle_lock = threading.Lock()
+        self._parking = [] # Connections handed back by workers, registered by the watcher thread
+        self._idle = {} # socket -> _Connection; only touched by the watcher thread
+        self._waiting = set() # Connections whose long-poll waits for a change
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        self._watcher = threading.Thread(target=self._watch_connections, name="apro-bridge-idle", daemon=True)
+        self._watcher.start()
+
+    def process_request(self, request, client_address):
+        # A new connection waits like an idle one until its first request arrives.
+        self._park(_Connection(request, client_address))
+
+    def _park(self, connection):
+        with self._idle_lock:
+            closing = self.closing
+            if not closing:
+                connection.idle_until = time.monotonic() + KEEP_ALIVE_TIMEOUT
+                self._parking.append(connection)
+        if closing:
+            self._close_connection(connection)
+        else:
+            self._wake_watcher()
+
+    def _hold(self, connection):
+        """Keep a deferred request off the pool until the change feed moves or its wait runs out."""
+        deferred = connection.handler._deferred
+        with self._idle_lock:
+            closing = self.closing
+            if not closing:
+                connection.resume_at = deferred["deadline"]
+                connection.listener = lambda: self._resume_soon(connection)
+                self._waiting.add(connection)
+        if closing:
+            self._close_connection(connection)
+            return
+        change_feed.subscribe(deferred["version"], connection.listener)
+        self._wake_watcher()
+
+    def _resume_soon(self, connection):
+        # Only seconds that are over are reported, so let this one end first.
+        resume_at = time.monotonic() + 1 - time.time() % 1
+        with self._idle_lock:
+            if connection in self._waiting:
+                connection.resume_at = min(connection.resume_at, resume_at)
+        self._wake_watcher()
+
+    def _wake_watcher(self):
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:
+            pass # A wake-up is already pending.
+
+    def _watch_connections(self):
+        """Hand connections to the pool as requests arrive or long-polls are due; close those idle too long."""
+        while True:
+            now = time.monotonic()
+            with self._idle_lock:
+                closing = self.closing
+                parking, self._parking = self._parking, []
+                due = [c for c in self._waiting if closing or c.resume_at <= now]
+                self._waiting.difference_update(due)
+                next_resume = min((c.resume_at for c in self._waiting), default=None)
+            for connection in due:
+                change_feed.unsubscribe(connection.listener)
+                if closing:
+                    self._close_connection(connection)
+                else:
+                    self._dispatch(connection, resume=True)
+            for connection in parking:
+                try:
+                    self._selector.register(connection.request, selectors.EVENT_READ, connection)
+                except (OSError, ValueError):
+                    self._close_connection(connection)
+                    continue
+                self._idle[connection.request] = connection
+            if closing:
+                break
+
+            expired = [c for c in self._idle.values() if c.idle_until <= now]
+            overflow = len(self._idle) - len(expired) - MAX_IDLE_CONNECTIONS
+            if overflow > 0:
+                expired += sorted((c for c in self._idle.values() if c.idle_until > now), key=lambda c: c.idle_until)[:overflow]
+            for connection in expired:
+                self._unwatch(connection)
+                self._close_connection(connection)
+
+            timeout = min([c.idle_until for c in self._idle.values()] + ([next_resume] if next_resume is not None else []), default=None)
+            for key, _ in self._selector.select(None if timeout is None else max(0.0, timeout - now)):
+                if key.fileobj is self._wakeup_reader:
+                    try:
+                        while self._wakeup_reader.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self._unwatch(key.data)
+                self._dispatch(key.data)
+
+        for connection in list(self._idle.values()):
+            self._unwatch(connection)
+            self._close_connection(connection)
+        self._selector.close()
+
+    def _unwatch(self, connection):
+        del self._idle[connection.request]
+        self._selector.unregister(connection.request)
+
+    def _dispatch(self, connection, resume=False):
+        # A resumed long-poll was accepted before, so it is never turned away.
+        with self._stats_lock:
+            if not resume and self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                reject = True
+            else:
+                self.in_flight += 1
+                reject = False
+        if reject:
+            self._reject_request(connection)
+            return
+        self.executor.submit(self._serve_connection, connection, resume)
+
+    def _serve_connection(self, connection, resume=False):
+        handler = connection.handler
+        served_before = handler._requests_served if handler is not None else 0
+        with self._stats_lock:
+            self.active += 1
+        try:
+            if handler is None:
+                connection.handler = self.RequestHandlerClass(connection.request, connection.client_address, self)
+            else:
+                handler.serve_next(resume)
+        except Exception:
+            self.handle_error(connection.request, connection.client_address)
+        finally:
+            handler = connection.handler
+            with self._stats_lock:
+                self.active -= 1
+                self.in_flight -= 1
+                self.served += (handler._requests_served if handler is not None else 0) - served_before
+            if handler is not None and handler._deferred is not None:
+                self._hold(connection)
+            elif handler is not None and not handler.close_connection:
+                self._park(connection)
+            else:
+                self._close_connection(connection)
+
+    def _close_connection(self, connection):
+        if connection.handler is not None:
+            connection.handler.close()
+        self.shutdown_request(connection.request)
+
+    def _reject_request(self, connection):
+        body = dump_json({"result": None, "error": "Apro - Bridge is busy, retry later."})
+        try:
+            connection.request.sendall(
+                b"HTTP/1.0 503 Service Unavailable\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Access-Control-Allow-Origin: *\r\n"
+                b"Retry-After: 1\r\n"
+                b"Connection: close\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode('ascii')
+                + body
+            )
+        except OSError:
+            pass
+        finally:
+            self._close_connection(connection)
+
+    def stats(self):
+        with self._idle_lock:
+            idle_connections = len(self._idle) + len(self._parking)
+            waiting = len(self._waiting)
+        with self._stats_lock:
+            return {
+                "maxWorkers": self.max_workers,
+                "maxInFlight": self.max_in_flight,
+                "inFlight": self.in_flight,
+                "active": self.active,
+                "queueDepth": self.in_flight - self.active,
+                "idleConnections": idle_connections,
+                "waiting": waiting,
+                "served": self.served,
+                "rejected": self.rejected,
+            }
+
+    def server_close(self):
+        with self._idle_lock:
+            self.closing = True
+        self._wake_watcher()
+        self._watcher.join()
+        super().server_close()
+        self.executor.shutdown(wait=False)
+        self.media_pool.shutdown(wait=False)
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
 
 class ServerThread(threading.Thread):
     def run(self):
-        self.server = HTTPServer((HOST, PORT), RequestHandler)
+        self.server = BridgeHTTPServer((HOST, PORT), RequestHandler)
         self.server.serve_forever()
     def stop(self):
         self.server.shutdown()
         self.server.server_close()
+        media_index.reset()
+        catalog_cache.invalidate()
+        model_schema_cache.reset()
+        search_cache.reset()
+        idempotency_cache.reset()
+        duplicate_index.reset()
 server_thread = None
 def start_server():
     global server_thread
     if server_thread is None:
+        start_logging()
         server_thread = ServerThread()
         server_thread.daemon = True
         server_thread.start()
@@ -546,6 +2661,7 @@ def stop_server():
     if server_thread is not None:
         server_thread.stop()
         server_thread = None
+        stop_logging()
 
 def setup_menu():
     action = QAction("About Apro - Bridge", mw)
@@ -555,3 +2671,12 @@ def setup_menu():
 addHook("profileLoaded", start_server)
 addHook("profileLoaded", setup_menu)
 addHook("unloadProfile", stop_server)
+gui_hooks.operation_did_execute.append(catalog_cache.on_operation_did_execute)
+gui_hooks.state_did_reset.append(catalog_cache.invalidate)
+gui_hooks.operation_did_execute.append(change_feed.on_operation_did_execute)
+gui_hooks.state_did_reset.append(change_feed.notify)
+gui_hooks.sync_did_finish.append(change_feed.on_sync_did_finish)
+notes_will_be_deleted.append(change_feed.on_notes_will_be_deleted)
+gui_hooks.operation_did_execute.append(duplicate_index.on_operation_did_execute)
+gui_hooks.state_did_reset.append(duplicate_index.reset)
+gui_hooks.sync_did_finish.append(duplicate_index.reset)
@@ -0,0 +1 @@
+"""Benchmark and load-test harness for Apro - Bridge; run with `python -m bench`."""
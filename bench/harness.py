@@ -0,0 +1,231 @@
+"""Load generator for the bridge running against the stand-in collection.
+
+Each action in the mix is first run on its own for its throughput and
+latency, then again for a shorter pass under tracemalloc for its peak
+memory, which slows everything down too much to time at once. Then the
+whole mix runs together for latency under contention. Workers keep one
+persistent connection each and pick actions from a seeded RNG, so runs with
+the same arguments send the same requests.
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from . import stub_anki
+
+ACTIONS = ("add", "patch", "tag", "notesInfo", "media", "atomic")
+DEFAULT_MIX = "add=3,patch=3,tag=2,notesInfo=2,media=1,atomic=1"
+ATOMIC_ROLLBACK_RATE = 0.25 # Share of atomic multi requests that fail on their last step and roll back
+ADDON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "__init__.py")
+
+def load_bridge():
+    """Install the stand-in modules and import the add-on as 'apro_bridge'."""
+    mw = stub_anki.install()
+    spec = importlib.util.spec_from_file_location("apro_bridge", ADDON_PATH)
+    bridge = importlib.util.module_from_spec(spec)
+    sys.modules["apro_bridge"] = bridge
+    spec.loader.exec_module(bridge)
+    return mw, bridge
+
+def start_server(bridge):
+    """Run the bridge's ServerThread on a free port and return (thread, port)."""
+    bridge.PORT = 0
+    thread = bridge.ServerThread(daemon=True)
+    thread.start()
+    while getattr(thread, 'server', None) is None:
+        time.sleep(0.01)
+    return thread, thread.server.server_address[1]
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"Unknown action '{name}'; expected one of {', '.join(ACTIONS)}.")
+        mix[name] = float(weight or 1)
+    return mix
+
+class Workload:
+    """Builds requests for each action; note IDs come from the seeded notes."""
+    def __init__(self, args, note_ids):
+        self.args = args
+        self.note_ids = note_ids
+        self._lock = threading.Lock()
+        self._counter = 0
+
+    def _text(self, rng):
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        return f"bench {counter} " + "".join(rng.choice("abcdefghij ") for _ in range(self.args.payload_size))
+
+    def request(self, action, rng):
+        """Return (method, path, body bytes, headers, expected status) for one request of action."""
+        json_headers = {"Content-Type": "application/json"}
+        if action == "add":
+            body = {"deck": "Bench", "noteType": "Basic", "fields": {"Front": self._text(rng), "Back": self._text(rng)}, "tags": ["bench"]}
+            return "POST", "/", json.dumps(body).encode('utf-8'), json_headers, 200
+        if action == "patch":
+            body = {"note": {"id": rng.choice(self.note_ids), "fields": {"Back": self._text(rng)}}}
+            return "PATCH", "/", json.dumps(body).encode('utf-8'), json_headers, 200
+        if action == "tag":
+            body = {"action": "addTags", "params": {"notes": rng.sample(self.note_ids, self.args.batch), "tags": f"bench-{rng.randrange(100)}"}}
+            return "POST", "/", json.dumps(body).encode('utf-8'), json_headers, 200
+        if action == "notesInfo":
+            body = {"action": "notesInfo", "params": {"notes": rng.sample(self.note_ids, self.args.batch)}}
+            return "POST", "/", json.dumps(body).encode('utf-8'), json_headers, 200
+        if action == "atomic":
+            steps = [
+                {"action": "updateNotes", "params": {"notes": [{"id": rng.choice(self.note_ids), "fields": {"Back": self._text(rng)}}]}},
+                {"action": "addTags", "params": {"notes": rng.sample(self.note_ids, self.args.batch), "tags": f"bench-{rng.randrange(100)}"}},
+            ]
+            rollback = rng.random() < ATOMIC_ROLLBACK_RATE
+            if rollback:
+                steps.append({"action": "addNote", "params": {"deck": "Bench", "noteType": "Missing", "fields": {"Front": "x"}}})
+            body = {"action": "multi", "params": {"atomic": True, "actions": steps}}
+            return "POST", "/", json.dumps(body).encode('utf-8'), json_headers, 400 if rollback else 200
+        return "PUT", "/?extension=mp3", rng.randbytes(self.args.media_size), {"Content-Type": "application/octet-stream"}, 200
+
+def run_phase(port, workload, mix, args, seed, requests=None):
+    """Send requests (default args.requests) from args.concurrency workers.
+
+    Returns ({action: [(seconds, ok)]}, wall seconds).
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    remaining = [requests or args.requests]
+    lock = threading.Lock()
+    samples = {name: [] for name in names}
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        connection = http.client.HTTPConnection("localhost", port, timeout=60)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            action = rng.choices(names, weights)[0]
+            method, path, body, headers, expected_status = workload.request(action, rng)
+            started_at = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == expected_status
+                if response.getheader('Connection', '').lower() == 'close':
+                    connection.close()
+            except (OSError, http.client.HTTPException):
+                ok = False
+                connection.close()
+            elapsed = time.perf_counter() - started_at
+            with lock:
+                samples[action].append((elapsed, ok))
+        connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started_at
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(samples, wall_seconds, peak_bytes=None):
+    rows = {}
+    for action, results in samples.items():
+        if not results:
+            continue
+        latencies = sorted(seconds for seconds, _ in results)
+        rows[action] = {
+            "requests": len(results),
+            "errors": sum(1 for _, ok in results if not ok),
+            "reqPerSec": len(results) / wall_seconds,
+            "p50Ms": percentile(latencies, 0.50) * 1000,
+            "p99Ms": percentile(latencies, 0.99) * 1000,
+            "peakMemoryMiB": peak_bytes / (1024 * 1024) if peak_bytes is not None else None,
+        }
+    return rows
+
+def format_table(title, rows):
+    lines = [title, f"{'action':<10} {'requests':>8} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'peak MiB':>9}"]
+    for action, row in rows.items():
+        peak = f"{row['peakMemoryMiB']:.1f}" if row['peakMemoryMiB'] is not None else "-"
+        lines.append(f"{action:<10} {row['requests']:>8} {row['errors']:>6} {row['reqPerSec']:>9.1f} "
+                     f"{row['p50Ms']:>8.2f} {row['p99Ms']:>8.2f} {peak:>9}")
+    return "\n".join(lines)
+
+def seed_notes(port, count):
+    connection = http.client.HTTPConnection("localhost", port, timeout=60)
+    note_ids = []
+    for start in range(0, count, 500):
+        notes = [{"deck": "Bench", "noteType": "Basic", "fields": {"Front": f"seed {i}", "Back": "seed"}, "tags": ["seed"]}
+                 for i in range(start, min(count, start + 500))]
+        connection.request("POST", "/", body=json.dumps({"action": "addNotes", "params": {"notes": notes}}),
+                           headers={"Content-Type": "application/json"})
+        note_ids.extend(r["noteId"] for r in json.loads(connection.getresponse().read())["result"])
+    connection.close()
+    return note_ids
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark Apro - Bridge against a stand-in Anki collection.")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel client connections (default 8)")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per phase (default 2000)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"action weights (default {DEFAULT_MIX})")
+    parser.add_argument("--notes", type=int, default=5000, help="notes created before measuring (default 5000)")
+    parser.add_argument("--payload-size", type=int, default=200, help="characters per generated field (default 200)")
+    parser.add_argument("--batch", type=int, default=50, help="note IDs per tag and notesInfo request (default 50)")
+    parser.add_argument("--media-size", type=int, default=64 * 1024, help="bytes per media upload (default 65536)")
+    parser.add_argument("--memory-requests", type=int, default=200, help="requests per action in the tracemalloc pass (default 200)")
+    parser.add_argument("--seed", type=int, default=1, help="RNG seed (default 1)")
+    parser.add_argument("--skip-isolated", action="store_true", help="only run the mixed phase")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON to PATH")
+    args = parser.parse_args(argv)
+
+    mw, bridge = load_bridge()
+    mw.col.models.add("Basic", ["Front", "Back"])
+    thread, port = start_server(bridge)
+    try:
+        note_ids = seed_notes(port, max(args.notes, args.batch))
+        workload = Workload(args, note_ids)
+        report = {"args": {k: v for k, v in vars(args).items() if k != "json"}, "isolated": {}, "mixed": {}}
+        print(f"Apro - Bridge benchmark: {args.concurrency} connections, {args.requests} requests per phase, "
+              f"{len(note_ids)} notes, payload {args.payload_size} chars, media {args.media_size} bytes")
+
+        if not args.skip_isolated:
+            for action in args.mix:
+                samples, wall_seconds = run_phase(port, workload, {action: 1}, args, args.seed)
+                tracemalloc.start()
+                baseline = tracemalloc.get_traced_memory()[0]
+                run_phase(port, workload, {action: 1}, args, args.seed, args.memory_requests)
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                tracemalloc.stop()
+                report["isolated"].update(summarize(samples, wall_seconds, peak))
+            print()
+            print(format_table("Isolated (one action at a time; peak memory includes the load generator):", report["isolated"]))
+
+        samples, wall_seconds = run_phase(port, workload, args.mix, args, args.seed + 1)
+        report["mixed"] = summarize(samples, wall_seconds)
+        report["mixedTotalReqPerSec"] = sum(len(results) for results in samples.values()) / wall_seconds
+        print()
+        print(format_table(f"Mixed ({report['mixedTotalReqPerSec']:.1f} req/s overall):", report["mixed"]))
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        thread.stop()
+        mw.col.media.cleanup()
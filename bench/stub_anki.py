@@ -0,0 +1,436 @@
+"""In-process stand-ins for the parts of aqt/anki the bridge uses.
+
+install() registers fake aqt, aqt.utils, aqt.qt, anki.* modules in
+sys.modules so the add-on can be imported on a machine without Anki. The
+collection is an in-memory SQLite database with Anki's notes/cards columns,
+and the task manager runs closures on a dedicated "main" thread, which is
+the only thread allowed to write to the collection, as in Anki. Every write
+is an undo step holding the rows it replaced, so custom undo entries,
+merging and undo behave like Anki's for the bridge's rollback paths.
+"""
+import hashlib
+import itertools
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+
+_ids = itertools.count(int(time.time() * 1000))
+UNDO_LIMIT = 30 # Undo steps kept, as in Anki
+
+class NotFoundError(Exception):
+    pass
+
+class OpChangesWithCount:
+    def __init__(self, count=0):
+        self.count = count
+
+class OpChanges:
+    def __init__(self, note_text=False, tag=False, notetype=False, deck=False):
+        self.note_text = note_text
+        self.tag = tag
+        self.notetype = notetype
+        self.deck = deck
+
+class OpChangesAfterUndo:
+    def __init__(self, operation, changes):
+        self.operation = operation
+        self.changes = changes
+
+class UndoStatus:
+    def __init__(self, undo="", redo="", last_step=0):
+        self.undo = undo
+        self.redo = redo
+        self.last_step = last_step
+
+class NameId:
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+
+def strip_html_media(text):
+    return re.sub(r"<[^>]*>", "", text)
+
+def field_checksum(text):
+    return int(hashlib.sha1(strip_html_media(text).encode('utf-8')).hexdigest()[:8], 16)
+
+def ids2str(ids):
+    return "(%s)" % ",".join(str(int(i)) for i in ids)
+
+class Note:
+    def __init__(self, col, model=None, id=None):
+        self.col = col
+        if id is not None:
+            row = col.db.first("select mid, tags, flds, mod from notes where id = ?", id)
+            if not row:
+                raise NotFoundError(f"Note {id} not found")
+            self.id = id
+            self.mid, tags, flds, self.mod = row
+            self.tags = tags.split()
+            self.fields = flds.split("\x1f")
+        else:
+            self.id = 0
+            self.mid = model['id']
+            self.mod = 0
+            self.tags = []
+            self.fields = [""] * len(model['flds'])
+
+    def note_type(self):
+        return self.col.models.get(self.mid)
+
+    def _field_map(self):
+        return {f['name']: idx for idx, f in enumerate(self.note_type()['flds'])}
+
+    def keys(self):
+        return list(self._field_map())
+
+    def items(self):
+        return [(name, self.fields[idx]) for name, idx in self._field_map().items()]
+
+    def __contains__(self, key):
+        return key in self._field_map()
+
+    def __getitem__(self, key):
+        return self.fields[self._field_map()[key]]
+
+    def __setitem__(self, key, value):
+        self.fields[self._field_map()[key]] = value
+
+    def has_tag(self, tag):
+        return tag.lower() in (t.lower() for t in self.tags)
+
+    def add_tag(self, tag):
+        if not self.has_tag(tag):
+            self.tags.append(tag)
+
+    def remove_tag(self, tag):
+        self.tags = [t for t in self.tags if t.lower() != tag.lower()]
+
+class Models:
+    def __init__(self, db):
+        self._db = db
+        self._models = {}
+
+    def add(self, name, fields, cloze=False):
+        mid = next(_ids)
+        front = "{{cloze:%s}}" % fields[0] if cloze else "{{%s}}" % fields[0]
+        self._models[mid] = {
+            "id": mid, "name": name, "type": 1 if cloze else 0, "mod": int(time.time()),
+            "flds": [{"name": f, "ord": i} for i, f in enumerate(fields)],
+            "tmpls": [{"name": "Card 1", "ord": 0, "qfmt": front, "afmt": front + "<hr id=answer>{{%s}}" % fields[-1]}],
+            "css": ".card { font-family: arial; font-size: 20px; text-align: center; }",
+        }
+        self._db.execute("insert into notetypes values (?, ?, ?)", mid, name, self._models[mid]['mod'])
+        return self._models[mid]
+
+    def by_name(self, name):
+        for model in self._models.values():
+            if model['name'] == name:
+                return model
+        return None
+
+    def get(self, mid):
+        return self._models.get(mid)
+
+    def all(self):
+        return list(self._models.values())
+
+    def all_names_and_ids(self):
+        return [NameId(m['name'], m['id']) for m in self._models.values()]
+
+class Decks:
+    def __init__(self):
+        self._decks = {"Default": 1}
+
+    def id(self, name, create=True):
+        if name not in self._decks:
+            self._decks[name] = next(_ids)
+        return self._decks[name]
+
+    def all_names_and_ids(self, skip_empty_default=False, include_filtered=True):
+        return [NameId(name, did) for name, did in self._decks.items()]
+
+class Tags:
+    def __init__(self, col):
+        self.col = col
+
+    def split(self, tags):
+        return tags.split()
+
+    def _bulk(self, note_ids, tags, add):
+        self.col._begin_step("Add Tags" if add else "Remove Tags")
+        self.col._save_rows("notes", list(note_ids))
+        changed = 0
+        for nid in note_ids:
+            note = self.col.get_note(nid)
+            before = list(note.tags)
+            for tag in tags.split():
+                note.add_tag(tag) if add else note.remove_tag(tag)
+            if note.tags != before:
+                self.col._write(note)
+                changed += 1
+        return OpChangesWithCount(changed)
+
+    def bulk_add(self, note_ids, tags):
+        return self._bulk(note_ids, tags, True)
+
+    def bulk_remove(self, note_ids, tags):
+        return self._bulk(note_ids, tags, False)
+
+class Media:
+    def __init__(self):
+        self._dir = tempfile.TemporaryDirectory(prefix="apro-bridge-bench-media-")
+
+    def dir(self):
+        return self._dir.name
+
+    def write_data(self, name, data):
+        with open(f"{self._dir.name}/{name}", 'wb') as f:
+            f.write(data)
+        return name
+
+    def cleanup(self):
+        self._dir.cleanup()
+
+class DB:
+    def __init__(self):
+        self._connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self._lock = threading.RLock()
+        # Same columns and indexes as Anki's notes and cards tables; notetypes only has the columns the bridge reads.
+        self._connection.executescript("""
+            create table notes (id integer primary key, guid text not null, mid integer not null, mod integer not null,
+                                usn integer not null, tags text not null, flds text not null, sfld text not null,
+                                csum integer not null, flags integer not null, data text not null);
+            create table cards (id integer primary key, nid integer not null, did integer not null, ord integer not null,
+                                mod integer not null, usn integer not null);
+            create table notetypes (id integer primary key, name text not null, mtime_secs integer not null);
+            create index ix_notes_usn on notes (usn);
+            create index ix_notes_csum on notes (csum);
+            create index idx_notes_mid on notes (mid);
+            create index ix_cards_nid on cards (nid);
+        """)
+
+    def execute(self, sql, *args):
+        with self._lock:
+            return self._connection.execute(sql, args)
+
+    def all(self, sql, *args):
+        with self._lock:
+            return [list(row) for row in self._connection.execute(sql, args).fetchall()]
+
+    def list(self, sql, *args):
+        with self._lock:
+            return [row[0] for row in self._connection.execute(sql, args).fetchall()]
+
+    def first(self, sql, *args):
+        with self._lock:
+            row = self._connection.execute(sql, args).fetchone()
+            return list(row) if row else None
+
+    def scalar(self, sql, *args):
+        row = self.first(sql, *args)
+        return row[0] if row else None
+
+class Collection:
+    def __init__(self):
+        self.db = DB()
+        self.models = Models(self.db)
+        self.decks = Decks()
+        self.tags = Tags(self)
+        self.media = Media()
+        self.main_thread = None
+        self._undo_steps = []
+        self._last_step = 0
+
+    def _check_main_thread(self):
+        if self.main_thread is not None and threading.current_thread() is not self.main_thread:
+            raise RuntimeError("Collection written from outside the main thread.")
+
+    def get_note(self, nid):
+        return Note(self, id=int(nid))
+
+    def _begin_step(self, name):
+        """Start a new undo step; the rows it changes are saved as they were before."""
+        self._check_main_thread()
+        self._last_step += 1
+        self._undo_steps.append({"id": self._last_step, "name": name, "rows": {}})
+        del self._undo_steps[:-UNDO_LIMIT]
+        return self._last_step
+
+    def _save_rows(self, table, ids):
+        saved = self._undo_steps[-1]["rows"]
+        ids = [i for i in ids if (table, i) not in saved]
+        if not ids:
+            return
+        rows = {row[0]: row for row in self.db.all(f"select * from {table} where id in {ids2str(ids)}")}
+        for i in ids:
+            saved[(table, i)] = rows.get(i)
+
+    def _write(self, note):
+        self._check_main_thread()
+        self._save_rows("notes", [note.id])
+        note.mod = int(time.time())
+        self.db.execute("update notes set tags = ?, flds = ?, sfld = ?, csum = ?, mod = ? where id = ?",
+                        " ".join(note.tags), "\x1f".join(note.fields), note.fields[0], field_checksum(note.fields[0]),
+                        note.mod, note.id)
+
+    def add_note(self, note, deck_id):
+        self._check_main_thread()
+        if not note.fields[0].strip():
+            raise ValueError("The first field is empty.")
+        self._begin_step("Add Note")
+        note.id = next(_ids)
+        self._save_rows("notes", [note.id])
+        note.mod = int(time.time())
+        self.db.execute("insert into notes values (?, ?, ?, ?, -1, ?, ?, ?, ?, 0, '')",
+                        note.id, str(note.id), note.mid, note.mod, " ".join(note.tags), "\x1f".join(note.fields),
+                        note.fields[0], field_checksum(note.fields[0]))
+        for template in note.note_type()['tmpls']:
+            card_id = next(_ids)
+            self._save_rows("cards", [card_id])
+            self.db.execute("insert into cards values (?, ?, ?, ?, ?, -1)", card_id, note.id, deck_id, template['ord'], note.mod)
+
+    def update_note(self, note):
+        self._begin_step("Update Note")
+        self._write(note)
+
+    def update_notes(self, notes):
+        self._begin_step("Update Notes")
+        for note in notes:
+            self._write(note)
+
+    def remove_notes(self, note_ids):
+        notes_will_be_deleted(self, note_ids)
+        self._begin_step("Delete Notes")
+        ids = ids2str(note_ids)
+        self._save_rows("notes", self.db.list(f"select id from notes where id in {ids}"))
+        self._save_rows("cards", self.db.list(f"select id from cards where nid in {ids}"))
+        count = self.db.scalar(f"select count() from notes where id in {ids}")
+        self.db.execute(f"delete from notes where id in {ids}")
+        self.db.execute(f"delete from cards where nid in {ids}")
+        return OpChangesWithCount(count)
+
+    def find_notes(self, query):
+        # Only "tag:<name>" and match-all searches are needed by the benchmark.
+        if query.startswith("tag:"):
+            tag = query[4:].lower()
+            return [nid for nid, tags in self.db.all("select id, tags from notes order by id") if tag in tags.lower().split()]
+        return self.db.list("select id from notes order by id")
+
+    def add_custom_undo_entry(self, name):
+        return self._begin_step(name)
+
+    def merge_undo_entries(self, target):
+        """Fold every step after target into it, keeping the oldest saved rows."""
+        self._check_main_thread()
+        index = next((i for i, step in enumerate(self._undo_steps) if step["id"] == target), None)
+        if index is None:
+            raise ValueError(f"Undo step {target} is no longer available.")
+        rows = self._undo_steps[index]["rows"]
+        for step in self._undo_steps[index + 1:]:
+            for key, row in step["rows"].items():
+                rows.setdefault(key, row)
+        del self._undo_steps[index + 1:]
+
+    def undo_status(self):
+        # As in Anki, last_step counts every operation, including undos.
+        return UndoStatus(undo=self._undo_steps[-1]["name"] if self._undo_steps else "", last_step=self._last_step)
+
+    def undo(self):
+        self._check_main_thread()
+        if not self._undo_steps:
+            raise ValueError("Nothing to undo.")
+        step = self._undo_steps.pop()
+        self._last_step += 1
+        for (table, row_id), row in step["rows"].items():
+            self.db.execute(f"delete from {table} where id = ?", row_id)
+            if row is not None:
+                self.db.execute(f"insert into {table} values ({', '.join('?' * len(row))})", *row)
+        return OpChangesAfterUndo(step["name"], OpChanges(note_text=True, tag=True))
+
+class TaskMan:
+    """Runs closures in order on a single thread standing in for Qt's main thread."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._closures = []
+        self._wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name="bench-main", daemon=True)
+        self.thread.start()
+
+    def run_on_main(self, closure):
+        with self._lock:
+            self._closures.append(closure)
+        self._wakeup.set()
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                closures, self._closures = self._closures, []
+            for closure in closures:
+                try:
+                    closure()
+                except Exception as e:
+                    print(f"Error in main-thread task: {e}", file=sys.stderr)
+
+class _Hook:
+    def __init__(self):
+        self._handlers = []
+
+    def append(self, handler):
+        self._handlers.append(handler)
+
+    def remove(self, handler):
+        self._handlers.remove(handler)
+
+    def __call__(self, *args):
+        for handler in list(self._handlers):
+            handler(*args)
+
+notes_will_be_deleted = _Hook()
+
+class _GuiHooks(types.ModuleType):
+    def __getattr__(self, name):
+        hook = _Hook()
+        setattr(self, name, hook)
+        return hook
+
+def install():
+    """Register the stand-in modules and return the fake main window."""
+    col = Collection()
+    taskman = TaskMan()
+    col.main_thread = taskman.thread
+    gui_hooks = _GuiHooks("aqt.gui_hooks")
+    mw = types.SimpleNamespace(col=col, taskman=taskman, form=types.SimpleNamespace(menuTools=None),
+                               reset=lambda: gui_hooks.state_did_reset(), update_undo_actions=lambda status=None: None)
+
+    aqt = types.ModuleType("aqt")
+    aqt.mw = mw
+    aqt.gui_hooks = gui_hooks
+    aqt_utils = types.ModuleType("aqt.utils")
+    aqt_utils.tooltip = lambda message, period=3000, **kwargs: None
+    aqt.utils = aqt_utils
+    aqt_qt = types.ModuleType("aqt.qt")
+    for name in ("QAction", "QMessageBox", "Qt"):
+        setattr(aqt_qt, name, object)
+
+    anki = types.ModuleType("anki")
+    anki_notes = types.ModuleType("anki.notes")
+    anki_notes.Note = Note
+    anki_utils = types.ModuleType("anki.utils")
+    anki_utils.ids2str = ids2str
+    anki_utils.strip_html_media = strip_html_media
+    anki_utils.field_checksum = field_checksum
+    anki_hooks = types.ModuleType("anki.hooks")
+    anki_hooks.addHook = lambda name, handler: None
+    anki_hooks.notes_will_be_deleted = notes_will_be_deleted
+
+    sys.modules.update({
+        "aqt": aqt, "aqt.gui_hooks": gui_hooks, "aqt.utils": aqt_utils, "aqt.qt": aqt_qt,
+        "anki": anki, "anki.notes": anki_notes, "anki.utils": anki_utils, "anki.hooks": anki_hooks,
+    })
+    return mw